@@ -0,0 +1,77 @@
+"""Compares the nodesdb codec with cPickle and json.
+
+Usage: python benchmarks/codec.py [scale]
+
+Each payload is encoded and decoded repeatedly, and the best time of
+each is reported with the encoded size.  json cannot represent
+Decimal, datetime or arrays, so it is given them as strings and
+lists, and does not get them back.
+
+"""
+import array
+import cPickle
+import datetime
+import decimal
+import json
+import sys
+import time
+
+sys.path.insert(0, '.')
+
+from nodesdb import codec
+
+
+def trades(count):
+    when = datetime.datetime(2013, 5, 1, 9, 30)
+    return [[decimal.Decimal('%d.25' % i), when + datetime.timedelta(seconds=i), 'DEAL%06d' % i, i, [i, i + 1]]
+            for i in xrange(count)]
+
+def curves(count):
+    return [[float(i * j) for j in xrange(100)] for i in xrange(count)]
+
+def vector(count):
+    return array.array('d', (float(i) for i in xrange(count)))
+
+def vectors(count):
+    return [array.array('d', [float(i), 1.0]) for i in xrange(count)]
+
+
+def timed(f, repeat=5):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        f()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def jsonDefault(value):
+    if isinstance(value, array.array):
+        return value.tolist()
+    return str(value)
+
+def report(name, payload):
+    formats = [
+        ('codec', codec.dumps, codec.loads),
+        ('codec/0copy', codec.dumps, lambda data: codec.loads(data, zeroCopy=True)),
+        ('cPickle', lambda value: cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL), cPickle.loads),
+        ('json', lambda value: json.dumps(value, default=jsonDefault), json.loads),
+    ]
+    for format, dumps, loads in formats:
+        data = dumps(payload)
+        encode = timed(lambda: dumps(payload))
+        decode = timed(lambda: loads(data))
+        print '%-10s %-12s %10d bytes %10.1f ms dumps %10.1f ms loads' % (
+            name, format, len(data), encode * 1e3, decode * 1e3)
+
+
+def main(scale):
+    print '%-10s %-12s %16s %19s %19s' % ('payload', 'format', 'size', 'best of 5', 'best of 5')
+    report('trades', trades(10000 * scale))
+    report('curves', curves(100 * scale))
+    report('vector', vector(1000000 * scale))
+    report('vectors', vectors(10000 * scale))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1)
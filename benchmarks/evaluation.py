@@ -0,0 +1,124 @@
+"""Compares plain recursive evaluation with evaluation under a depth limit.
+
+Usage: python benchmarks/evaluation.py [depth] [width]
+
+Warm runs recompute a graph whose edges are already recorded, after
+invalidating all of it; cold runs evaluate a new object's nodes for
+the first time.
+
+"""
+import sys
+import threading
+import time
+
+sys.path.insert(0, '.')
+
+import nodes
+import nodes.graph
+
+
+class Chain(nodes.GraphObject):
+
+    @nodes.graphMethod(nodes.Settable)
+    def Base(self):
+        return 0
+
+    @nodes.graphMethod
+    def Level(self, n):
+        if n == 0:
+            return self.Base()
+        return self.Level(n - 1) + 1
+
+
+class FanIn(nodes.GraphObject):
+
+    @nodes.graphMethod(nodes.Settable)
+    def Base(self):
+        return 0
+
+    @nodes.graphMethod
+    def Leaf(self, n):
+        return self.Base() + n
+
+    @nodes.graphMethod
+    def Total(self, n):
+        return sum(self.Leaf(i) for i in xrange(n))
+
+
+def timed(f, repeat=5):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        f()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def deepChain(depth):
+    c = Chain()
+    def run():
+        c.Base = c.Base() + 1       # Invalidates the whole chain.
+        c.Level(depth)
+    return run
+
+
+def coldChain(depth):
+    def run():
+        Chain().Level(depth)        # No edges recorded yet.
+    return run
+
+
+def wideFanIn(width):
+    f = FanIn()
+    def run():
+        f.Base = f.Base() + 1
+        f.Total(width)
+    return run
+
+
+def coldFanIn(width):
+    def run():
+        FanIn().Total(width)
+    return run
+
+
+def report(name, count, maxComputeDepth, run):
+    nodes.graph._graph.maxComputeDepth = maxComputeDepth
+    try:
+        elapsed = timed(run)
+    except RuntimeError as e:
+        print '%-12s %-12s %10s' % (name, maxComputeDepth, 'failed: %s' % e)
+        return
+    finally:
+        nodes.graph._graph.maxComputeDepth = None
+    print '%-12s %-12s %10.1f ms %8.2f us/node' % (name, maxComputeDepth, elapsed * 1e3, elapsed * 1e6 / count)
+
+
+def main(depth, width):
+    print '%-12s %-12s %13s' % ('graph', 'depth limit', 'best of 5')
+    report('chain', depth, None, deepChain(depth))
+    for limit in (16, 64, 256):
+        report('chain', depth, limit, deepChain(depth))
+    report('fan-in', width, None, wideFanIn(width))
+    for limit in (16, 64, 256):
+        report('fan-in', width, limit, wideFanIn(width))
+    report('cold chain', depth, None, coldChain(depth))
+    for limit in (16, 64, 256):
+        report('cold chain', depth, limit, coldChain(depth))
+    report('cold fan-in', width, None, coldFanIn(width))
+    for limit in (16, 64, 256):
+        report('cold fan-in', width, limit, coldFanIn(width))
+
+
+if __name__ == '__main__':
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    width = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+
+    # Give the recursive engine enough stack to finish the chain.
+    sys.setrecursionlimit(depth * 10 + 1000)
+    threading.stack_size(512 * 1024 * 1024)
+    thread = threading.Thread(target=main, args=(depth, width))
+    thread.start()
+    threading.stack_size(0)     # Threads the depth limit starts need no more than usual.
+    thread.join()
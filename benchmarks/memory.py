@@ -0,0 +1,67 @@
+"""Measures the resident memory used per graph node.
+
+Usage: python benchmarks/memory.py [objects] [none|lru|cost]
+
+Each object contributes a settable input, a fan of derived nodes
+reading it and a total reading the fan, so the graph holds both
+leaf, intermediate and root nodes in roughly trading-book ratios.
+
+The second argument attaches a NodeCache bounded to 1024 entries,
+or a CostAwareNodeCache with its default thresholds, under which
+every node here is cheap.
+
+"""
+import gc
+import resource
+import sys
+
+sys.path.insert(0, '.')
+
+import nodes
+import nodes.graph
+
+
+class Cashflow(nodes.GraphObject):
+
+    @nodes.graphMethod(nodes.Settable)
+    def Notional(self):
+        return 100
+
+    @nodes.graphMethod
+    def Amount(self, period):
+        return self.Notional() * period
+
+    @nodes.graphMethod
+    def Total(self):
+        return sum(self.Amount(p) for p in xrange(1, 5))
+
+
+def rss():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def main(count, cache='none'):
+    graph = nodes.graph._graph
+    if cache == 'lru':
+        graph.nodeCache = nodes.NodeCache(maxEntries=1024)
+    elif cache == 'cost':
+        graph.nodeCache = nodes.CostAwareNodeCache()
+    objects = [Cashflow() for _ in xrange(count)]
+    gc.collect()
+    before = rss()
+    for o in objects:
+        o.Total()
+    gc.collect()
+    after = rss()
+    nodeCount = len(graph._nodesByKey)
+    print 'objects:         %d' % count
+    print 'nodes:           %d' % nodeCount
+    print 'bytes per node:  %.0f' % (float(after - before) / nodeCount)
+    if graph.nodeCache is not None:
+        print 'cache:           %r' % graph.nodeCache.stats()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000,
+         sys.argv[2] if len(sys.argv) > 2 else 'none')
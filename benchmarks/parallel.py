@@ -0,0 +1,62 @@
+"""Measures how scenario evaluation scales with worker processes.
+
+Usage: python benchmarks/parallel.py [scenarios] [work]
+
+Each scenario bumps one curve point and reprices a book whose
+pricing work is proportional to `work`.
+
+"""
+import multiprocessing
+import sys
+import time
+
+sys.path.insert(0, '.')
+
+import nodes
+
+
+class Book(nodes.GraphObject):
+
+    @nodes.graphMethod(nodes.Settable)
+    def Point(self, n):
+        return 1.0 + n / 100.0
+
+    @nodes.graphMethod(nodes.Settable)
+    def Work(self):
+        return 1000
+
+    @nodes.graphMethod
+    def Price(self, n):
+        total = 0.0
+        for i in xrange(self.Work()):
+            total += self.Point(n) / (1.0 + i)
+        return total
+
+    @nodes.graphMethod
+    def Total(self):
+        return sum(self.Price(n) for n in xrange(20))
+
+
+def main(scenarios, work):
+    book = Book(Work=work)
+    whatIfSets = [[nodes.NodeChange(book.Point, 2.0, n % 20)] for n in xrange(scenarios)]
+    outputs = [book.Total.node()]
+    book.Total()
+    cores = multiprocessing.cpu_count()
+    print '%d cores, %d scenarios' % (cores, scenarios)
+    print '%-10s %10s %8s' % ('processes', 'seconds', 'speedup')
+    baseline = None
+    processes = 1
+    while processes <= max(cores, 2):
+        start = time.time()
+        nodes.scenarioValues(whatIfSets, outputs, processes=processes)
+        elapsed = time.time() - start
+        baseline = baseline or elapsed
+        print '%-10d %10.2f %8.2f' % (processes, elapsed, baseline / elapsed)
+        processes *= 2
+
+
+if __name__ == '__main__':
+    scenarios = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    work = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    main(scenarios, work)
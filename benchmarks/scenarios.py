@@ -0,0 +1,51 @@
+"""Measures the cost of reading through nested scenarios, and of
+entering and exiting them.
+
+Usage: python benchmarks/scenarios.py [nodes]
+
+"""
+import sys
+import time
+
+sys.path.insert(0, '.')
+
+import nodes
+
+
+class Curve(nodes.GraphObject):
+
+    @nodes.graphMethod(nodes.Settable)
+    def Point(self, n):
+        return n
+
+
+def main(count):
+    curve = Curve()
+    points = [curve.Point.node((n,)) for n in xrange(count)]
+    for n in xrange(count):
+        curve.Point(n)
+    print '%-8s %14s %14s' % ('depth', 'read us/node', 'enter+exit ms')
+    for depth in (0, 1, 4, 16, 64):
+        scenarios = [nodes.scenario() for _ in xrange(depth)]
+        for n, s in enumerate(scenarios):
+            with s:
+                curve.Point.setWhatIf(-n, n)
+        for s in scenarios:
+            s.__enter__()
+        start = time.time()
+        for n in xrange(count):
+            curve.Point(n)
+        read = time.time() - start
+        for s in reversed(scenarios):
+            s.__exit__(None, None, None)
+        start = time.time()
+        for s in scenarios:
+            s.__enter__()
+        for s in reversed(scenarios):
+            s.__exit__(None, None, None)
+        enterExit = time.time() - start
+        print '%-8d %14.2f %14.2f' % (depth, read * 1e6 / count, enterExit * 1e3)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
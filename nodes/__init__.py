@@ -11,6 +11,10 @@ import inspect
 import types
 
 from graph import *
+from parallel import scenarioValues
+from cache import NodeCache, CostAwareNodeCache
+from profiler import GraphProfiler
+import introspect
 
 ReadOnly     = NodeDescriptor.READONLY
 Settable     = NodeDescriptor.SETTABLE
@@ -50,6 +54,7 @@ class GraphMethodDescriptor(NodeDescriptor):
 
 
 class GraphMethod(NodeDescriptorBound):
+    __slots__ = ()
 
     @property
     def name(self):
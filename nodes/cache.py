@@ -0,0 +1,188 @@
+"""Bounds the memory held by computed node values.
+
+By default a graph keeps every value it computes until the value is
+invalidated.  A NodeCache attached to a graph instead keeps at most a
+given number of computed values, or values of at most a given total
+size, and evicts the least recently used of them when the budget is
+exceeded.  Set and what-if values are never evicted.
+
+An evicted value is simply marked invalid, exactly as if one of its
+inputs had changed: the node's edges are left alone, so invalidation
+still reaches everything downstream of it, and the value is computed
+again the next time it is read.  The evicted NodeData is dropped,
+so that threads reading it without the lock never see its value
+cleared; in a scenario it is replaced by an invalid one, which still
+shadows its parents' values.
+
+A CostAwareNodeCache only bounds the values that are cheap to
+recompute, and keeps the expensive ones for as long as they are
+valid.
+
+"""
+import sys
+
+from graph import NodeData
+
+
+class NodeCache(object):
+    """Evicts computed values once a graph holds more than maxEntries
+    of them, or more than maxBytes as measured by sizeof.
+
+    Recency is tracked with the CLOCK approximation of LRU: a value
+    read from the cache is marked as referenced, and eviction sweeps
+    the cached values in the order they were computed, evicting the
+    first one not referenced since the sweep last passed it.  A read
+    therefore costs a single dictionary lookup.
+
+    The hits, misses and evictions counters count reads of valid
+    values, reads that needed a computation, and evicted values.
+
+    """
+    def __init__(self, maxEntries=None, maxBytes=None, sizeof=sys.getsizeof):
+        if maxEntries is None and maxBytes is None:
+            raise RuntimeError("A node cache needs a maximum number of entries or bytes.")
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self._sizeof = sizeof
+        self._entries = {}      # NodeData -> [size, referenced, or None if no longer evictable]
+        self._clock = []        # Cached NodeData, in sweep order.
+        self._hand = 0
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def entries(self):
+        return len(self._entries)
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': self.entries, 'bytes': self.bytes}
+
+    def clear(self):
+        """Forgets the cached values without evicting them."""
+        self._entries.clear()
+        del self._clock[:]
+        self._hand = 0
+        self._bytes = 0
+
+    def _hit(self, nodeData):
+        self.hits += 1
+        entry = self._entries.get(nodeData)
+        if entry is not None and entry[1] is not None:
+            entry[1] = True
+
+    def _add(self, nodeData, cost):
+        """Caches a value just computed into nodeData in cost
+        seconds, evicting others as needed.  Called with the graph
+        lock held.
+
+        """
+        size = self._sizeof(nodeData._value) if self.maxBytes is not None else 0
+        entry = self._entries.get(nodeData)
+        if entry is None:
+            self._entries[nodeData] = [size, True]
+            self._clock.append(nodeData)
+        else:
+            self._bytes -= entry[0]
+            entry[0] = size
+            entry[1] = True
+        self._bytes += size
+        while ((self.maxEntries is not None and len(self._clock) > self.maxEntries)
+               or (self.maxBytes is not None and self._bytes > self.maxBytes and len(self._clock) > 1)):
+            self._evict()
+
+    def _evict(self):
+        """Evicts the first value the clock hand finds unreferenced,
+        dropping on the way any entries that are no longer valid or
+        no longer evictable.
+
+        """
+        clock = self._clock
+        while clock:
+            if self._hand >= len(clock):
+                self._hand = 0
+            nodeData = clock[self._hand]
+            entry = self._entries[nodeData]
+            valid = nodeData._flags & NodeData.VALID and nodeData._node._graph is not None
+            if valid and entry[1]:
+                entry[1] = False
+                self._hand += 1
+                continue
+            clock[self._hand] = clock[-1]
+            clock.pop()
+            del self._entries[nodeData]
+            self._bytes -= entry[0]
+            if valid and entry[1] is not None:
+                nodeData._flags &= ~NodeData.VALID
+                self.evictions += 1
+                self._evicted(nodeData)
+            return
+
+    def _evicted(self, nodeData):
+        # The value is released by dropping the NodeData rather than
+        # clearing it, since a thread reading without the lock may
+        # have seen it valid and be about to read the value.
+        node = nodeData._node
+        dataStore = nodeData._dataStore
+        if dataStore._nodeDataByNodeId.get(node._id) is nodeData:
+            if dataStore is node._graph._rootDataStore:
+                dataStore._nodeDataDelete(node)
+            else:
+                dataStore._nodeDataSet(NodeData(node, dataStore))
+
+
+class CostAwareNodeCache(NodeCache):
+    """Keeps values that took at least minCost seconds to compute,
+    or that have been computed minReuse times, for as long as they
+    are valid; the cheap rest are only kept until they are evicted
+    under the maxEntries and maxBytes budgets.
+
+    The cost of a value is the time taken to compute it including
+    any of its inputs computed along the way, i.e. the time it
+    would take to recompute if none of them were kept.  A graph
+    method declared with cache=True is always kept, and one
+    declared with cache=False is always treated as cheap.
+
+    """
+    def __init__(self, minCost=0.001, minReuse=3, maxEntries=1024, maxBytes=None, sizeof=sys.getsizeof):
+        NodeCache.__init__(self, maxEntries=maxEntries, maxBytes=maxBytes, sizeof=sizeof)
+        self.minCost = minCost
+        self.minReuse = minReuse
+        self._evictionsByNodeId = {}
+        self.kept = 0
+
+    def stats(self):
+        stats = NodeCache.stats(self)
+        stats['kept'] = self.kept
+        return stats
+
+    def clear(self):
+        NodeCache.clear(self)
+        self._evictionsByNodeId.clear()
+
+    def _add(self, nodeData, cost):
+        node = nodeData._node
+        keep = node._descriptor._descriptor._cache
+        if keep is None:
+            keep = cost >= self.minCost or self._evictionsByNodeId.get(node._id, 0) >= self.minReuse
+        if not keep:
+            NodeCache._add(self, nodeData, cost)
+            return
+        self.kept += 1
+        self._evictionsByNodeId.pop(node._id, None)
+        entry = self._entries.get(nodeData)
+        if entry is not None:   # No longer cheap; the clock drops it.
+            self._bytes -= entry[0]
+            entry[0] = 0
+            entry[1] = None
+
+    def _evicted(self, nodeData):
+        nodeId = nodeData._node._id
+        self._evictionsByNodeId[nodeId] = self._evictionsByNodeId.get(nodeId, 0) + 1
+        NodeCache._evicted(self, nodeData)
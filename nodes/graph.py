@@ -1,11 +1,28 @@
 import collections
 import logging
+import Queue
+import sys
+import thread
+import threading
+import time
+import weakref
 
 
 class CLEAR(object):
     """Sentinel to allow a node to be reset (cleared)."""
 CLEAR = CLEAR()
 
+_MAX_EDGE_TUPLE = 8     # Edges beyond this many are kept in a set.
+_MAX_NODE_CACHE = 256   # Argument tuples cached per bound method.
+
+
+class _ObjRef(weakref.ref):
+    """A weak reference to a graph object, carrying the object's id,
+    so that one callback serves every object, and its nodes.
+
+    """
+    __slots__ = ('objId', 'nodes')
+
 
 class NodeDescriptor(object):
     # TODO: Remove or refactor this class.
@@ -16,11 +33,13 @@ class NodeDescriptor(object):
     SERIALIZABLE = 0x0004                   # 00000100
     STORED       = SETTABLE|SERIALIZABLE    # 00000111
 
-    def __init__(self, function, flags=0, name=None, delegate=None, **kwargs):
+    def __init__(self, function, flags=0, name=None, delegate=None, cache=None, equals=None, **kwargs):
         self._function = function
         self._flags = flags
         self._name = name
         self._delegate = delegate
+        self._cache = cache     # True or False overrides a cost-aware NodeCache.
+        self._equals = equals   # Compares values for early cutoff in place of ==.
         for k, v in kwargs.items():
             setattr(self, k, v)
 
@@ -40,6 +59,14 @@ class NodeDescriptor(object):
     def delegate(self):
         return self._delegate
 
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def equals(self):
+        return self._equals
+
     @property
     def overlayable(self):
         return self.flags & self.OVERLAYABLE == self.OVERLAYABLE
@@ -57,14 +84,34 @@ class NodeDescriptor(object):
         return self.flags & self.STORED == self.STORED
 
 class NodeDescriptorBound(object):
+    """A node descriptor bound to an object.
+
+    The bound descriptor caches the nodes it resolves: the node
+    for a call without arguments in _node, and up to
+    _MAX_NODE_CACHE nodes for calls with arguments in _nodesByArgs.
+    A cached node that has since been removed from the graph has
+    no graph, and is resolved again.
+
+    Nodes of objects that can be weakly referenced are keyed by the
+    object's id rather than by the object itself, and share a copy of
+    the bound descriptor that references the object weakly, so that
+    the graph does not keep the object alive.  See Graph.release.
+
+    """
+    __slots__ = ('_obj', '_objKey', '_descriptor', '_node', '_nodesByArgs', '_weakBound')
 
     def __init__(self, obj, descriptor):
         self._obj = obj
+        self._objKey = id(obj) if type(obj).__weakrefoffset__ else obj
         self._descriptor = descriptor
+        self._node = None
+        self._nodesByArgs = None
+        self._weakBound = None
 
     @property
     def obj(self):
-        return self._obj
+        obj = self._obj
+        return obj() if type(obj) is weakref.ref else obj
 
     @property
     def descriptor(self):
@@ -86,8 +133,12 @@ class NodeDescriptorBound(object):
     def delegate(self):
         return self.descriptor.delegate
 
-    def subscribe(self, callback):
-        return _graph.nodeSubscribe(self.node(), callback)
+    @property
+    def cache(self):
+        return self.descriptor.cache
+
+    def subscribe(self, callback, push=False):
+        return _graph.nodeSubscribe(self.node(), callback, push=push)
 
     @staticmethod
     def unsubscribe(subscription):
@@ -117,14 +168,50 @@ class NodeDescriptorBound(object):
     def method(self):
         return self.descriptor.function
 
+    def _weak(self):
+        """Returns a copy of the bound descriptor referencing the
+        object weakly, or the descriptor itself if the object cannot
+        be weakly referenced or it already is a weak copy.
+
+        The copy is made once and shared by every node of the bound
+        method.
+
+        """
+        bound = self._weakBound
+        if bound is not None:
+            return bound
+        obj = self._obj
+        if self._objKey is obj or type(obj) is weakref.ref:
+            return self
+        bound = object.__new__(self.__class__)
+        bound._obj = weakref.ref(obj)
+        bound._objKey = self._objKey
+        bound._descriptor = self._descriptor
+        bound._node = bound._nodesByArgs = bound._weakBound = None
+        self._weakBound = bound
+        return bound
+
     def key(self, args=()):
-        return (self.obj, self.method) + args
+        return (self._objKey, self.method) + args
 
     def node(self, args=()):
-        return _graph.nodeResolve(self, args=args)
+        if not args:
+            node = self._node
+            if node is None or node._graph is None:
+                node = self._node = _graph.nodeResolve(self)
+            return node
+        nodesByArgs = self._nodesByArgs
+        if nodesByArgs is None:
+            nodesByArgs = self._nodesByArgs = {}
+        node = nodesByArgs.get(args)
+        if node is None or node._graph is None:
+            if len(nodesByArgs) >= _MAX_NODE_CACHE:
+                nodesByArgs.clear()
+            node = nodesByArgs[args] = _graph.nodeResolve(self, args=args)
+        return node
 
     def __call__(self, *args):
-        return _graph.nodeValue(self.node(args=args))
+        return _graph.nodeValue(self.node(args))
 
     def _setData(self, value):
         logging.warn("Calling %s.setData: this is an experimental method." % self.__class__.__name__)
@@ -144,22 +231,37 @@ class NodeDescriptorBound(object):
 
 
 class Node(object):
+    """A node in the graph.
 
-    def __init__(self, graph, key, descriptor, args=(), flags=0):
+    There can be tens of millions of nodes in a process, so nodes
+    use __slots__, and their edges are kept in tuples until they
+    grow past _MAX_EDGE_TUPLE entries, after which they move to a
+    set (see Graph.nodeAddDependency).  Most nodes have only a
+    handful of inputs and outputs.
+
+    """
+    __slots__ = ('_graph', '_id', '_key', '_descriptor', '_args', '_flags', '_inputNodes', '_outputNodes')
+
+    def __init__(self, graph, id, key, descriptor, args=(), flags=0):
         self._graph = graph
+        self._id = id
         self._key = key
         self._descriptor = descriptor
         self._args = args
 
         # TODO: Remove flags, or use descriptor's flags.
         self._flags = flags
-        self._inputNodes = set()
-        self._outputNodes = set()
+        self._inputNodes = ()
+        self._outputNodes = ()
 
     @property
     def graph(self):
         return self._graph
 
+    @property
+    def id(self):
+        return self._id
+
     @property
     def key(self):
         return self._key
@@ -212,6 +314,10 @@ class Node(object):
     def delegate(self):
         return self.descriptor.delegate
 
+    @property
+    def cache(self):
+        return self.descriptor.cache
+
     def valid(self, dataStore=None):
         return self._graph.nodeData(self, dataStore=dataStore).valid
 
@@ -223,9 +329,12 @@ class Node(object):
         return self._graph.nodeValue(self, dataStore=dataStore)
 
 class NodeData(object):
+    __slots__ = ('_node', '_dataStore', '_flags', '_value')
+
     NONE  = 0x0000
     VALID = 0x0001
     FIXED = 0x0002
+    DIRTY = 0x0004      # Possibly stale; the old value is kept for early cutoff.
 
     def __init__(self, node, dataStore):
         self._node = node
@@ -266,6 +375,8 @@ class NodeData(object):
             return 'FIXED|VALID'
         if self.valid:
             return 'VALID'
+        if self.flags & self.DIRTY:
+            return 'DIRTY'
 
 class NodeChange(object):
     def __init__(self, descriptor, value, *args):
@@ -275,7 +386,7 @@ class NodeChange(object):
 
     @property
     def node(self):
-        return self.descriptor.node(*self.args)
+        return self.descriptor.node(self.args)
 
 class NodeSubscription(object):
 
@@ -283,10 +394,16 @@ class NodeSubscription(object):
                  callback,
                  descriptor,
                  args=(),
+                 nodeId=None,
                  ):
         self._callback = callback
         self._descriptor = descriptor
         self._args = args
+        self._nodeId = nodeId
+
+    @property
+    def nodeId(self):
+        return self._nodeId
 
     @property
     def descriptor(self):
@@ -303,25 +420,353 @@ class NodeSubscription(object):
     def notify(self):
         self.callback(self.descriptor, *self._args)
 
-class GraphState(object):
+class NodePushSubscription(NodeSubscription):
+    """A subscription delivering a node's new value after each set
+    or batch of sets that changes it; see Graph.nodeSubscribe.
+
+    """
+    def notify(self, value):
+        self.callback(self.descriptor, value, *self._args)
+
+class NodeSubscriptionIndex(object):
+    """Indexes subscriptions by the id of the node subscribed to.
+
+    Only nodes with subscriptions have an entry, so looking up a
+    node without any, as invalidation does for every node it
+    touches, allocates nothing; an entry is dropped as soon as its
+    last subscription is.  Pull and push subscriptions (see
+    Graph.nodeSubscribe) are kept apart, since they are fired at
+    different times.
+
+    """
+    def __init__(self):
+        self._pull = {}
+        self._push = {}
+
+    def __len__(self):
+        return len(self._pull) + len(self._push)
+
+    def subscribed(self, nodeId):
+        """Returns True if the node has any subscriptions."""
+        return nodeId in self._pull or nodeId in self._push
+
+    def add(self, subscription):
+        index = self._push if isinstance(subscription, NodePushSubscription) else self._pull
+        subscriptions = index.get(subscription._nodeId)
+        if subscriptions is None:
+            subscriptions = index[subscription._nodeId] = set()
+        subscriptions.add(subscription)
+
+    def discard(self, subscription):
+        index = self._push if isinstance(subscription, NodePushSubscription) else self._pull
+        subscriptions = index.get(subscription._nodeId)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del index[subscription._nodeId]
+
+    def discardNode(self, nodeId):
+        """Drops every subscription to the node."""
+        self._pull.pop(nodeId, None)
+        self._push.pop(nodeId, None)
+
+    def pullSubscriptions(self, nodes):
+        """Returns the set of pull subscriptions to any of the nodes."""
+        index = self._pull
+        subscriptions = set()
+        if index:
+            for node in nodes:
+                found = index.get(node._id)
+                if found is not None:
+                    subscriptions.update(found)
+        return subscriptions
+
+    def pushSubscriptions(self, nodeId):
+        return self._push.get(nodeId, ())
+
+    def pushed(self, nodes):
+        """Returns those of the nodes with push subscriptions."""
+        index = self._push
+        if not index:
+            return []
+        return [node for node in nodes if node._id in index]
+
+class GraphBatch(object):
+    """Collects sets and clears (and what-ifs), including those made
+    by delegates, and applies them as one transaction.
+
+    Changes made while a batch is open are not visible until it is
+    committed, at which point the values are applied, everything
+    downstream of them is invalidated in one sweep, and every
+    affected subscription is notified once.  If the batch is
+    aborted, or applying it fails, nothing is changed.
+
+    A batch opened while another is open joins the outer one.
+
+        with graph.batch():
+            env.BusinessDate = date
+            env.MarketDate = date
+
+    """
+    def __init__(self, graph):
+        self._graph = graph
+        self._changes = collections.OrderedDict()
+        self._outer = None
+
+    def __enter__(self):
+        state = self._graph._state
+        if state._batch is not None:
+            self._outer = state._batch
+            return self._outer
+        state._batch = self
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if self._outer is not None:
+            return
+        self._graph._state._batch = None
+        if excType is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def _nodeSet(self, node, value, dataStore, notify=True):
+        self._changes[(node, dataStore)] = (value, notify)
+
+    def _nodeClear(self, node, dataStore, notify=True):
+        change = self._changes.get((node, dataStore))
+        if change is None:
+            nodeData = dataStore.nodeData(node, createIfMissing=False, searchParent=False)
+            if not nodeData or not nodeData.fixed:
+                raise RuntimeError("You cannot clear a value that hasn't been set.")
+        elif change[0] is CLEAR:
+            raise RuntimeError("You cannot clear a value that hasn't been set.")
+        self._changes[(node, dataStore)] = (CLEAR, notify)
+
+    def abort(self):
+        """Discards the changes collected so far."""
+        self._changes.clear()
+
+    def commit(self):
+        """Applies the changes collected so far."""
+        graph = self._graph
+        changes, self._changes = self._changes, collections.OrderedDict()
+        changedByDataStore = collections.OrderedDict()
+        notify = set()
+        pushDataStores = set()      # Those with changes to push; see Graph._nodesPush.
+        undo = []
+        try:
+            for (node, dataStore), (value, notifies) in changes.iteritems():
+                nodeData = dataStore.nodeData(node, createIfMissing=False, searchParent=False)
+                if value is CLEAR:
+                    if not nodeData or not nodeData.fixed:
+                        continue
+                    undo.append((node, dataStore, nodeData, nodeData._flags, nodeData._value))
+                    dataStore._nodeDataDelete(node)
+                else:
+                    if nodeData and nodeData.fixed and nodeData._value == value:
+                        continue
+                    if nodeData:
+                        undo.append((node, dataStore, nodeData, nodeData._flags, nodeData._value))
+                    else:
+                        undo.append((node, dataStore, None, None, None))
+                    nodeData = dataStore.nodeData(node, searchParent=False)
+                    nodeData._value = value
+                    nodeData._flags |= (NodeData.FIXED|NodeData.VALID)
+                changedByDataStore.setdefault(dataStore, []).append(node)
+                if notifies:
+                    notify.add(node)
+                    pushDataStores.add(dataStore)
+        except:
+            for node, dataStore, nodeData, flags, value in reversed(undo):
+                if nodeData is None:
+                    dataStore._nodeDataDelete(node)
+                    continue
+                nodeData._flags = flags
+                nodeData._value = value
+                dataStore._nodeDataSet(nodeData)
+            raise
+        pushes = []
+        for dataStore, nodes in changedByDataStore.iteritems():
+            invalidated = graph._nodesInvalidateOutputs(nodes, dataStore=dataStore)
+            notify.update(invalidated)
+            if dataStore in pushDataStores:
+                pushes.append((invalidated.union(nodes), dataStore))
+        graph.onNodesChanged(notify)
+        for nodes, dataStore in pushes:
+            graph._nodesPush(nodes, dataStore)
+
+
+class NodeFetch(object):
+    """A node value being fetched by one of the graph's fetch
+    threads; see Graph.nodeValueAsync.
+
+    The fetch runs in the data stores that were active when it was
+    started, so it must be waited on before they are exited; those
+    the caller enters meanwhile are not seen by it.  If no fetch
+    thread has picked it up by the time get is called, it is run by
+    the calling thread instead.
+
+    """
+    __slots__ = ('_graph', '_node', '_dataStore', '_stack',
+                 '_threadId', '_done', '_value', '_error')
+
+    def __init__(self, graph, node, dataStore):
+        self._graph = graph
+        self._node = node
+        self._dataStore = dataStore
+        self._stack = list(graph._state._activeDataStoreStack)
+        self._threadId = None   # Of the thread running the fetch.
+        self._done = threading.Event()
+        self._value = None
+        self._error = None
+
+    @property
+    def node(self):
+        return self._node
+
+    def ready(self):
+        return self._done.is_set()
+
+    def get(self):
+        """Returns the node's value, waiting for it if necessary."""
+        graph = self._graph
+        if self._claim():
+            self._run()
+        elif not self._done.is_set():
+            threadId = thread.get_ident()
+            with graph._lock:
+                graph._waitingThreads[threadId] = self._threadId
+            self._done.wait()
+            with graph._lock:
+                del graph._waitingThreads[threadId]
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._value
+
+    def _claim(self):
+        with self._graph._lock:
+            if self._threadId is not None:
+                return False
+            self._threadId = thread.get_ident()
+            return True
+
+    def _run(self):
+        graph = self._graph
+        state = graph._state
+        saved = (state._activeParentNode, state._activeDataStoreStack, state._overlay, state._computeDepth)
+        state._activeParentNode = None
+        state._activeDataStoreStack = list(self._stack)
+        state._overlay = {}
+        state._computeDepth = 0
+        try:
+            self._value = graph.nodeValue(self._node, dataStore=self._dataStore)
+        except Exception:
+            self._error = sys.exc_info()
+        finally:
+            (state._activeParentNode, state._activeDataStoreStack,
+             state._overlay, state._computeDepth) = saved
+            self._done.set()
+
+
+class GraphState(threading.local):
     """Collects run-time state for a graph.
 
+    The state is thread-local: each thread evaluating the graph has
+    its own active parent node, data store stack and batch.
+
     """
     def __init__(self, graph):
         self._graph = graph
         self._activeParentNode = None
-        self._activeDataStoreStack = None
-        self._subscriptionsByNodeKey = collections.defaultdict(lambda: set())
+        self._activeReads = None        # Nodes read by the active parent; see Graph.pruneEdges.
+        self._activeDataStoreStack = [graph._rootDataStore]
+        self._computeDepth = 0
+        self._batch = None
+        self._overlay = {}
 
 class Graph(object):
+    """A dependency graph of nodes and the data stores holding
+    their values.
+
+    If maxComputeDepth is None, nodes are computed by plain
+    recursion, so the depth of a dependency chain is bounded by
+    the Python stack.  Otherwise, at most maxComputeDepth nodes
+    are computed on one thread's stack before the evaluation
+    carries on down a new thread, which lets chains of any depth
+    be evaluated.  Every maxComputeDepth levels of a chain cost
+    the start of a thread, which is held until the chain is done.
+
+    Up to fetchThreads nodes are fetched concurrently by
+    nodeValueAsync and nodeValues.
+
+    If nodeCache is set (see nodes.cache.NodeCache), it decides how
+    many computed values the graph keeps; otherwise it keeps them
+    all.  Values computed before a cache is attached are not
+    tracked by it.
+
+    While profiler is set (see nodes.profiler.GraphProfiler), every
+    read, computation and invalidation is reported to it.
+
+    If pruneEdges is set, a node recomputed in the root data store
+    is detached from any inputs it no longer reads.  This is not
+    done while a scenario is active, since values computed there
+    may still depend on them.
+
+    If earlyCutoff is set, invalidation only marks the nodes
+    downstream of a change as possibly dirty, keeping their values.
+    A possibly dirty node is reused as is if none of its inputs has
+    changed value since it was last computed, and a recomputed node
+    whose value compares equal to its old one (see the equals
+    argument of graphMethod) does not count as changed, so nothing
+    downstream of it is recomputed.  Changes are tracked with the
+    graph's mutation count as a revision number: each data store
+    records, for each node, the revision at which its value last
+    changed and the one at which it was last verified.
+
+    Any number of threads may use the graph at once.  Reading a
+    valid node takes no lock, so a value once valid is never cleared
+    in place: invalidation only clears its flag, and a reader sees
+    either the old value or the new one.  Structural changes (new
+    nodes and edges) and the bookkeeping around a computation take
+    the graph lock briefly; a node being computed by one thread is
+    not computed again by another, which waits for the result
+    instead.  A value computed while another thread changed the
+    graph is returned but not kept.
 
-    def __init__(self, dataStoreClass=None, stateClass=None):
+    """
+
+    def __init__(self, dataStoreClass=None, stateClass=None, maxComputeDepth=None, fetchThreads=8, nodeCache=None,
+                 profiler=None, pruneEdges=True, earlyCutoff=False):
+        self._dataStores = weakref.WeakSet()
         self._dataStoreClass = dataStoreClass or GraphDataStore
         self._rootDataStore = self._dataStoreClass(self)
         self._nodesByKey = {}
+        self._nodesById = {}
+        self._nextNodeId = 0
+        self._objRefs = {}              # Object id -> _ObjRef to the object and its nodes.
+        self._releasedObjIds = []       # Of objects collected since last checked.
+        released = self._releasedObjIds
+        self._objCollected = lambda ref: released.append(ref.objId)
+        self._subscriptions = NodeSubscriptionIndex()
+        self._hydrators = weakref.WeakKeyDictionary()     # Object -> hydrator of its stored values.
+        self._paged = {}                # Node id -> (pager, fixed) of values not yet paged in.
         self._stateClass = stateClass or GraphState
         self._state = self._stateClass(self)
-        self._state._activeDataStoreStack = [self._rootDataStore]
+        self.maxComputeDepth = maxComputeDepth
+        self._mutations = 0     # Counts changes to the graph; see Scenario.
+        self._invalidations = 0         # Counts the starts and ends of invalidation sweeps,
+        self._sweeping = 0              # and the sweeps under way; see _nodeCompute.
+        self._lock = threading.Lock()
+        self._computingThreads = {}     # (node id, data store id) -> [thread id, event or None]
+        self._waitingThreads = {}       # Thread id -> id of the thread it waits on.
+        self._activeScenarios = set()   # Entered in any thread.
+        self.fetchThreads = fetchThreads
+        self._fetchQueue = None         # Started on first use.
+        self.nodeCache = nodeCache
+        self.profiler = profiler
+        self.pruneEdges = pruneEdges
+        self.earlyCutoff = earlyCutoff
 
     @property
     def computing(self):
@@ -340,14 +785,85 @@ class Graph(object):
         return self._state._activeDataStoreStack[0]
 
     def activeDataStorePush(self, dataStore):
-        parentDataStore = self.activeDataStore
-        self._state._activeDataStoreStack.append(dataStore)
+        state = self._state
+        stack = state._activeDataStoreStack
+        parentDataStore = stack[-1]
+        stack.append(dataStore)
+        dataStore._activeStack = stack
+        if len(stack) > 2 and (parentDataStore._activeStack is not stack or parentDataStore._activeOverlay is None):
+            # The parent was entered by another thread, whose stack a
+            # fetch thread has copied; that thread's overlay is not
+            # kept up to date here, so lookups walk the parents instead.
+            dataStore._activeOverlay = None
+        else:
+            state._overlay.update(dataStore._nodeDataByNodeId)
+            dataStore._activeOverlay = state._overlay
+        with self._lock:
+            self._activeScenarios.add(dataStore)
         return parentDataStore
 
     def activeDataStorePop(self):
         if self.activeDataStore == self.rootDataStore:
             raise RuntimeError("You cannot exit the root data store.")
-        return self._state._activeDataStoreStack.pop()
+        state = self._state
+        stack = state._activeDataStoreStack
+        dataStore = stack[-1]
+        overlay = state._overlay
+        if len(stack) > 2 and dataStore._activeOverlay is not None:
+            # The overlay is brought up to date before the pop, since
+            # fetch threads reading in the data store below use it as
+            # soon as it is the top of the stack again.
+            for nodeId in dataStore._nodeDataByNodeId:
+                for parentDataStore in reversed(stack[1:-1]):
+                    nodeData = parentDataStore._nodeDataByNodeId.get(nodeId)
+                    if nodeData is not None:
+                        overlay[nodeId] = nodeData
+                        break
+                else:
+                    overlay.pop(nodeId, None)
+        stack.pop()
+        dataStore._activeStack = dataStore._activeOverlay = None
+        with self._lock:
+            self._activeScenarios.discard(dataStore)
+        if len(stack) == 1:
+            overlay.clear()
+        return dataStore
+
+    def _overlayUpdate(self, dataStore, nodeId):
+        """Brings the overlay entry for a node up to date after the
+        node's data in an active data store has changed.
+
+        The overlay maps node ids to the data visible from the
+        active data store, for all the active data stores above
+        the root; with it, a lookup from the active data store
+        costs the same however many scenarios are active.  Each
+        thread has its own overlay, which the data stores active
+        in that thread refer to.
+
+        """
+        overlay = dataStore._activeOverlay
+        if overlay is None:
+            return
+        stack = dataStore._activeStack
+        if stack[-1] is dataStore:
+            nodeData = dataStore._nodeDataByNodeId.get(nodeId)
+            if nodeData is not None:
+                overlay[nodeId] = nodeData
+                return
+        for dataStore in reversed(stack[1:]):
+            nodeData = dataStore._nodeDataByNodeId.get(nodeId)
+            if nodeData is not None:
+                overlay[nodeId] = nodeData
+                return
+        overlay.pop(nodeId, None)
+
+    def _overlayRebuild(self, dataStore):
+        overlay = dataStore._activeOverlay
+        if overlay is None:
+            return
+        overlay.clear()
+        for dataStore in dataStore._activeStack[1:]:
+            overlay.update(dataStore._nodeDataByNodeId)
 
     def nodeKey(self, descriptor, args=()):
         """Returns a key for the node given computation details.
@@ -366,16 +882,33 @@ class Graph(object):
         a new node is created and added to the graph.
 
         """
+        if self._releasedObjIds:
+            self._objsReleaseCollected()
         key = self.nodeKey(descriptor, args=args)
         node = self._nodesByKey.get(key)
         if not node and createIfMissing:
-            node = self.nodeCreate(key, descriptor, args=args)
+            with self._lock:
+                node = self._nodesByKey.get(key)
+                if not node:
+                    node = self.nodeCreate(key, descriptor, args=args)
         return node
 
+    def nodeFromId(self, nodeId):
+        """Returns the node with the given id, or None if there
+        is no such node in the graph.
+
+        """
+        return self._nodesById.get(nodeId)
+
     def nodeCreate(self, key, descriptor, args=()):
         """Creates a new node, identified by key, based on the
         specified computation, and adds it to the graph.
 
+        The key is interned here: the node is also given a dense
+        integer id, and everything else in the graph (data stores,
+        subscriptions) refers to the node by that id rather than by
+        rehashing its key.
+
         If the node already exists, a RuntimeError is raised.
 
         Returns the new node.
@@ -383,16 +916,259 @@ class Graph(object):
         """
         if key in self._nodesByKey:
             raise RuntimeError("A node with that key value already exists in this graph.")
-        node = self._nodesByKey[key] = Node(self, key, descriptor, args=args)
+        descriptor = descriptor._weak()
+        nodeId = self._nextNodeId
+        self._nextNodeId += 1
+        node = self._nodesByKey[key] = self._nodesById[nodeId] = Node(self, nodeId, key, descriptor, args=args)
+        ref = descriptor._obj
+        if type(ref) is weakref.ref:
+            objId = descriptor._objKey
+            objRef = self._objRefs.get(objId)
+            if objRef is not None and objRef() is not ref():
+                self._objRelease(objId)     # Collected, its id since reused.
+                objRef = None
+            if objRef is None:
+                objRef = self._objRefs[objId] = _ObjRef(ref(), self._objCollected)
+                objRef.objId = objId
+                objRef.nodes = []
+            objRef.nodes.append(node)
         return node
 
+    def release(self, obj):
+        """Removes every node of the object from the graph, along
+        with their edges, their data in every data store and their
+        subscriptions.
+
+        Anything computed from the object's nodes is invalidated in
+        the active data stores first, as by nodeRemove.  Objects that
+        are garbage collected have their nodes removed the same way,
+        but without the invalidation, the next time a node is
+        resolved; nothing can read them again.  Note that a node
+        taking an object as an argument keeps that object alive.
+
+        """
+        if self.computing:
+            raise RuntimeError("You cannot modify the graph while it is updating its state.")
+        objId = id(obj)
+        ref = self._objRefs.get(objId)
+        if ref is None or ref() is not obj:
+            return
+        nodes = ref.nodes
+        for dataStore in self.activeDataStores:
+            self.nodesInvalidateOutputs(nodes, dataStore=dataStore)
+        with self._lock:
+            self._objRelease(objId)
+
+    def _objsReleaseCollected(self):
+        with self._lock:
+            released = self._releasedObjIds
+            count = len(released)
+            for objId in released[:count]:
+                ref = self._objRefs.get(objId)
+                if ref is not None and ref() is None:
+                    self._objRelease(objId)
+            del released[:count]
+
+    def _objRelease(self, objId):
+        """Drops the object's nodes.  Must be called with the lock
+        held.
+
+        """
+        for node in self._objRefs.pop(objId).nodes:
+            self._nodeDrop(node)
+
+    def _nodeDrop(self, node, dataStores=None):
+        """Detaches the node from its inputs and outputs, and drops
+        its data and subscriptions and the node itself.  Must be
+        called with the lock held.
+
+        """
+        for input in tuple(node._inputNodes):
+            self._nodeRemoveDependency(node, input)
+        for output in tuple(node._outputNodes):
+            self._nodeRemoveDependency(output, node)
+        for dataStore in (dataStores if dataStores is not None else self._dataStores):
+            dataStore._nodeDataDelete(node)
+        self._subscriptions.discardNode(node._id)
+        if self._paged:
+            self._paged.pop(node._id, None)
+        del self._nodesByKey[node._key]
+        del self._nodesById[node._id]
+        node._graph = None
+
+    def nodeRemove(self, node):
+        """Removes the node from the graph.
+
+        Any outputs of the node are invalidated first, since
+        they can no longer be recomputed from it, and the node is
+        then detached from its inputs and outputs, its data is
+        dropped from every data store, and its subscriptions are
+        discarded.
+
+        A removed node has no graph; anything caching the node
+        (see NodeDescriptorBound.node) uses this to tell it must
+        resolve the node again.
+
+        """
+        if self.computing:
+            raise RuntimeError("You cannot modify the graph while it is updating its state.")
+        if self._nodesById.get(node._id) is not node:
+            raise RuntimeError("This node is not in this graph.")
+        for dataStore in self.activeDataStores:
+            self.nodeInvalidateOutputs(node, dataStore=dataStore)
+        with self._lock:
+            objId = node._descriptor._objKey
+            objRef = self._objRefs.get(objId)
+            if objRef is not None and node in objRef.nodes:
+                objRef.nodes.remove(node)
+                if not objRef.nodes:
+                    del self._objRefs[objId]
+            self._nodeDrop(node)
+
+    def collect(self):
+        """Drops the nodes that hold nothing worth keeping, and
+        compacts the graph's tables.
+
+        A node is collected if it has no valid or set value in any
+        data store, no subscriptions, and no outputs but nodes being
+        collected with it; all that is lost is that it would have to
+        be resolved again.  Invalid data left in the root data store
+        is dropped as well.  The tables are then copied, since dicts
+        and sets never shrink as entries are removed.
+
+        The graph is locked for the whole pass, and nodes being
+        computed by other threads are kept, so collect is safe to
+        call between requests in a server.  Returns the numbers of
+        nodes, edges and NodeData reclaimed.
+
+        """
+        if self.computing:
+            raise RuntimeError("You cannot collect the graph while it is updating its state.")
+        if self._state._batch is not None:
+            raise RuntimeError("You cannot collect the graph within a batch.")
+        if self._releasedObjIds:
+            self._objsReleaseCollected()
+        with self._lock:
+            dataStores = list(self._dataStores)
+            nodeDataCount = sum(len(dataStore._nodeDataByNodeId) for dataStore in dataStores)
+            keep = set(nodeId for nodeId, dataStoreId in self._computingThreads)
+            keep.update(self._paged)
+            rootDataStore = self._rootDataStore
+            for nodeData in rootDataStore._nodeDataByNodeId.values():
+                if not nodeData._flags and nodeData._node._id not in keep:
+                    rootDataStore._nodeDataDelete(nodeData._node)
+
+            for dataStore in dataStores:
+                for nodeId, nodeData in dataStore._nodeDataByNodeId.iteritems():
+                    if nodeData._flags & (NodeData.VALID | NodeData.FIXED):
+                        keep.add(nodeId)
+            subscribed = self._subscriptions.subscribed
+            collectable = lambda node: not node._outputNodes and node._id not in keep and not subscribed(node._id)
+
+            work = [node for node in self._nodesById.itervalues() if collectable(node)]
+            collected = []
+            edges = 0
+            shrunk = set()
+            while work:
+                node = work.pop()
+                inputs = tuple(node._inputNodes)
+                edges += len(inputs)
+                self._nodeDrop(node, dataStores=dataStores)
+                collected.append(node)
+                for input in inputs:
+                    if collectable(input):
+                        work.append(input)
+                    elif type(input._outputNodes) is set:
+                        shrunk.add(input)
+
+            for node in shrunk:
+                if node._graph is not None:
+                    outputs = node._outputNodes
+                    node._outputNodes = tuple(outputs) if len(outputs) <= _MAX_EDGE_TUPLE else set(outputs)
+            for objId in set(node._descriptor._objKey for node in collected):
+                objRef = self._objRefs.get(objId)
+                if objRef is None:
+                    continue
+                nodes = [node for node in objRef.nodes if node._graph is not None]
+                if nodes:
+                    objRef.nodes = nodes
+                else:
+                    del self._objRefs[objId]
+
+            self._nodesByKey = dict(self._nodesByKey)
+            self._nodesById = dict(self._nodesById)
+            for dataStore in dataStores:
+                dataStore._nodeDataByNodeId = dict(dataStore._nodeDataByNodeId)
+                dataStore._stamps = dict(dataStore._stamps)
+            return {'nodes': len(collected), 'edges': edges,
+                    'nodeData': nodeDataCount - sum(len(dataStore._nodeDataByNodeId) for dataStore in dataStores)}
+
     def nodeAddDependency(self, node, dependency):
         """Adds the dependency as an input to the node, and the node
         as an output of the dependency.
 
         """
-        node._inputNodes.add(dependency)
-        dependency._outputNodes.add(node)
+        if dependency in node._inputNodes:
+            return
+        with self._lock:
+            self._nodeAddDependency(node, dependency)
+
+    def _nodeAddDependency(self, node, dependency):
+        inputs = node._inputNodes
+        if dependency in inputs:
+            return
+        if type(inputs) is set:
+            inputs.add(dependency)
+        elif len(inputs) < _MAX_EDGE_TUPLE:
+            node._inputNodes = inputs + (dependency,)
+        else:
+            node._inputNodes = set(inputs)
+            node._inputNodes.add(dependency)
+        outputs = dependency._outputNodes
+        if type(outputs) is set:
+            outputs.add(node)
+        elif len(outputs) < _MAX_EDGE_TUPLE:
+            dependency._outputNodes = outputs + (node,)
+        else:
+            dependency._outputNodes = set(outputs)
+            dependency._outputNodes.add(node)
+
+    def nodeRemoveDependency(self, node, dependency):
+        """Removes the dependency from the node's inputs, and the node
+        from the dependency's outputs.
+
+        """
+        if dependency not in node._inputNodes:
+            return
+        with self._lock:
+            self._nodeRemoveDependency(node, dependency)
+
+    def _nodeRemoveDependency(self, node, dependency):
+        inputs = node._inputNodes
+        if type(inputs) is set:
+            inputs.discard(dependency)
+        else:
+            node._inputNodes = tuple(n for n in inputs if n is not dependency)
+        outputs = dependency._outputNodes
+        if type(outputs) is set:
+            outputs.discard(node)
+        else:
+            dependency._outputNodes = tuple(n for n in outputs if n is not node)
+
+    def _nodePruneInputs(self, node, reads):
+        """Removes the node's inputs that are not among the nodes it
+        read when last computed.  Must be called with the lock held.
+
+        Edges are only ever removed here, once the node has been
+        computed, so a node's inputs are diffed rather than cleared
+        and rebuilt, and an input read every time is never touched.
+
+        """
+        reads = set(reads)
+        if len(node._inputNodes) == len(reads):
+            return
+        for input in [input for input in node._inputNodes if input not in reads]:
+            self._nodeRemoveDependency(node, input)
 
     #
     # The functions below work on node data.
@@ -413,28 +1189,257 @@ class Graph(object):
         If the final value returned is not valid, we raise an exception.
 
         """
-        dataStore = dataStore or self.activeDataStore
-
-        if self._state._activeParentNode:
-            self.nodeAddDependency(self._state._activeParentNode, node)
-
-        nodeData = self.nodeData(node, dataStore=dataStore, createIfMissing=False)
-        if nodeData and nodeData.valid:
-            return nodeData.value
+        state = self._state
+        dataStore = dataStore or state._activeDataStoreStack[-1]
+
+        if state._activeParentNode:
+            self.nodeAddDependency(state._activeParentNode, node)
+            if state._activeReads is not None:
+                state._activeReads.append(node)
+
+        nodeData = dataStore.nodeData(node, createIfMissing=False)
+        if nodeData and nodeData._flags & NodeData.VALID:
+            if self.nodeCache is not None:
+                self.nodeCache._hit(nodeData)
+            if self.profiler is not None:
+                self.profiler._hit(node)
+            return nodeData._value
+        if (self._paged or self._hydrators) and self._nodeHydrate(node):
+            nodeData = dataStore.nodeData(node, createIfMissing=False)
+            if nodeData and nodeData._flags & NodeData.VALID:
+                return nodeData._value
         if not computeInvalid:
             raise RuntimeError("Node is invalid and computeInvalid is False.")
+        if self.nodeCache is not None:
+            self.nodeCache.misses += 1
 
+        if self.maxComputeDepth is not None and state._computeDepth >= self.maxComputeDepth:
+            return self._nodeComputeContinued(node, dataStore)
         if not nodeData or nodeData.dataStore != dataStore:
-            nodeData = self.nodeData(node, dataStore=dataStore, searchParent=False)
+            nodeData = dataStore.nodeData(node, searchParent=False)
+        return self._nodeCompute(node, nodeData)
+
+    def nodeValueAsync(self, node, dataStore=None):
+        """Starts fetching the node's value on a fetch thread, and
+        returns a NodeFetch whose get method returns it.
 
+        Called from a computation, the node is recorded as an input
+        of the node being computed straight away, as nodeValue
+        would.  Fetches for the same node share a single
+        computation.
+
+        """
+        state = self._state
+        dataStore = dataStore or state._activeDataStoreStack[-1]
+
+        if state._activeParentNode:
+            self.nodeAddDependency(state._activeParentNode, node)
+            if state._activeReads is not None:
+                state._activeReads.append(node)
+
+        fetch = NodeFetch(self, node, dataStore)
+        nodeData = dataStore.nodeData(node, createIfMissing=False)
+        if nodeData and nodeData._flags & NodeData.VALID:
+            fetch._threadId = thread.get_ident()
+            fetch._value = nodeData._value
+            fetch._done.set()
+            return fetch
+        if self._fetchQueue is None:
+            self._fetchThreadsStart()
+        self._fetchQueue.put(fetch)
+        return fetch
+
+    def nodeValues(self, nodes, dataStore=None):
+        """Returns the values of the nodes, computing those that are
+        invalid concurrently.
+
+        """
+        fetches = [self.nodeValueAsync(node, dataStore=dataStore) for node in nodes]
+        return [fetch.get() for fetch in fetches]
+
+    def _fetchThreadsStart(self):
+        with self._lock:
+            if self._fetchQueue is not None:
+                return
+            queue = Queue.Queue()
+            for i in xrange(self.fetchThreads):
+                t = threading.Thread(target=self._fetchThreadRun, args=(queue,))
+                t.daemon = True
+                t.start()
+            self._fetchQueue = queue
+
+    @staticmethod
+    def _fetchThreadRun(queue):
+        while True:
+            fetch = queue.get()
+            if fetch._claim():
+                fetch._run()
+
+    def _nodeCompute(self, node, nodeData):
+        """Computes the node's value into nodeData, recording the
+        node as the parent of any node it reads.
+
+        If another thread is already computing the node in the same
+        data store, waits for it and returns its result instead.
+        The value is only kept if no invalidation sweep was under
+        way while it was being computed, since it may have read
+        inputs the sweep had not reached yet.
+
+        """
+        dataStore = nodeData._dataStore
+        key = (node._id, dataStore._id)
+        threadId = thread.get_ident()
+        lock = self._lock
+        while True:
+            lock.acquire()
+            if nodeData._flags & NodeData.VALID:
+                lock.release()
+                return nodeData._value
+            computing = self._computingThreads.get(key)
+            if computing is None:
+                computing = self._computingThreads[key] = [threadId, None]
+                break
+            if self._waitsOn(computing[0], threadId):
+                if self.maxComputeDepth is not None:
+                    # With the depth limited, a cycle would go on
+                    # starting threads rather than overflow the stack.
+                    lock.release()
+                    raise RuntimeError("Cycle detected while computing %s.%s." % (node.typename, node.name))
+                # Reentered, or the other thread is waiting on this
+                # one; compute it here rather than deadlock.
+                computing = None
+                break
+            if computing[1] is None:
+                computing[1] = threading.Event()
+            self._waitingThreads[threadId] = computing[0]
+            lock.release()
+            computing[1].wait()
+            with lock:
+                del self._waitingThreads[threadId]
+            nodeData = dataStore.nodeData(node, searchParent=False)
+        invalidations = self._invalidations if not self._sweeping else None
+        revision = self._mutations
+        lock.release()
+
+        nodeCache = self.nodeCache
+        if nodeCache is not None:
+            start = time.time()
+        profiler = self.profiler
+        if profiler is not None:
+            profiler._enter(node)
+        state = self._state
+        savedParentNode = state._activeParentNode
+        savedReads = state._activeReads
+        state._activeParentNode = None
+        reads = state._activeReads = None
+        state._computeDepth += 1
+        value = keep = stamp = None
         try:
-            savedParentNode = self._state._activeParentNode
-            self._state._activeParentNode = node
-            nodeData._value = node.method(node.obj, *node.args)
-            nodeData._flags |= nodeData.VALID
+            cutoff = self.earlyCutoff
+            if cutoff and nodeData._flags & NodeData.DIRTY and self._nodeUnchanged(node, nodeData):
+                value = nodeData._value
+                stamp = dataStore._stamps[node._id][0], revision
+            else:
+                state._activeParentNode = node
+                if node._inputNodes and self.pruneEdges and dataStore is self._rootDataStore and not self._activeScenarios:
+                    reads = state._activeReads = []
+                value = node.method(node.obj, *node.args)
+                if cutoff:
+                    stamp = self._nodeStamp(node, nodeData, value, revision)
+            keep = True
         finally:
-            self._state._activeParentNode = savedParentNode
-        return nodeData.value
+            state._activeParentNode = savedParentNode
+            state._activeReads = savedReads
+            state._computeDepth -= 1
+            if profiler is not None:
+                profiler._exit(keep)
+            lock.acquire()
+            if keep and self._invalidations == invalidations:
+                nodeData._value = value
+                nodeData._flags = (nodeData._flags | NodeData.VALID) & ~NodeData.DIRTY
+                if stamp is not None:
+                    dataStore._stamps[node._id] = stamp
+                if nodeCache is not None:
+                    nodeCache._add(nodeData, time.time() - start)
+                if reads is not None:
+                    self._nodePruneInputs(node, reads)
+            if computing is not None:
+                del self._computingThreads[key]
+            lock.release()
+            if computing is not None and computing[1] is not None:
+                computing[1].set()
+        return value
+
+    def _nodeUnchanged(self, node, nodeData):
+        """Returns True if none of the inputs of the possibly dirty
+        node has changed since it was last verified, bringing each
+        of them up to date in turn.
+
+        """
+        dataStore = nodeData._dataStore
+        stamp = dataStore._stamps.get(node._id)
+        if stamp is None:
+            return False
+        verified = stamp[1]
+        for input in tuple(node._inputNodes):
+            try:
+                self.nodeValue(input, dataStore=dataStore)
+            except Exception:
+                return False
+            inputData = dataStore.nodeData(input, createIfMissing=False)
+            inputStamp = inputData._dataStore._stamps.get(input._id) if inputData else None
+            if inputStamp is None or inputStamp[0] > verified:
+                return False
+        return True
+
+    def _nodeStamp(self, node, nodeData, value, revision):
+        """Returns the (changed, verified) revisions for a value just
+        computed at the given revision into nodeData.
+
+        """
+        stamp = nodeData._dataStore._stamps.get(node._id)
+        if stamp is not None and nodeData._flags & NodeData.DIRTY:
+            equals = node._descriptor._descriptor._equals
+            try:
+                if equals(nodeData._value, value) if equals else nodeData._value == value:
+                    return stamp[0], revision
+            except Exception:
+                pass
+        return revision, revision
+
+    def _nodeComputeContinued(self, node, dataStore):
+        """Computes the node on a new thread, once the computations in
+        progress on this one have reached maxComputeDepth.
+
+        The computations in progress are not unwound: this thread
+        waits for the new one, whose stack the evaluation carries on
+        down, so no method runs more than once however deep the
+        chain.  While it waits, this thread counts as waiting on the
+        new one, so that a cycle through both is detected.
+
+        """
+        fetch = NodeFetch(self, node, dataStore)
+        threadId = thread.get_ident()
+        def run():
+            with self._lock:
+                fetch._threadId = self._waitingThreads[threadId] = thread.get_ident()
+            fetch._run()
+        thread.start_new_thread(run, ())
+        fetch._done.wait()
+        with self._lock:
+            del self._waitingThreads[threadId]
+        return fetch.get()
+
+    def _waitsOn(self, threadId, otherThreadId):
+        """Returns True if the thread is, or is waiting on, the other
+        thread.  Must be called with the lock held.
+
+        """
+        while threadId is not None:
+            if threadId == otherThreadId:
+                return True
+            threadId = self._waitingThreads.get(threadId)
+        return False
 
     # TODO: Rename nodeChanges, and apply changes in usual
     #       set routines.
@@ -444,14 +1449,30 @@ class Graph(object):
             self.nodeSetValue(change.node, change.value, dataStore=dataStore, callDelegate=False)
         return
 
-    def nodeSubscribe(self, node, callback):
-        subscription = NodeSubscription(callback, node.descriptor, args=node.args)
-        self._state._subscriptionsByNodeKey[node.key].add(subscription)
+    def nodeSubscribe(self, node, callback, push=False):
+        """Subscribes the callback to changes to the node.
+
+        By default the callback is called as callback(descriptor,
+        *args) whenever the node is set or invalidated, and is left
+        to read the new value itself.  If push is set, it is instead
+        called as callback(descriptor, value, *args) with the node's
+        recomputed value after each set, clear or batch changing it.
+
+        """
+        subscriptionClass = NodePushSubscription if push else NodeSubscription
+        subscription = subscriptionClass(callback, node.descriptor, args=node.args, nodeId=node._id)
+        with self._lock:
+            self._subscriptions.add(subscription)
         return subscription
 
     def nodeUnsubscribe(self, subscription):
-        node = self.nodeResolve(subscription.descriptor, subscription.args, createIfMissing=False)
-        self._state._subscriptionsByNodeKey[node.key].discard(subscription)
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def nodeUnsubscribeAll(self, nodeId):
+        """Drops every subscription to the node with the given id."""
+        with self._lock:
+            self._subscriptions.discardNode(nodeId)
 
     def _nodeSetData(self, node, value):
         """Sets a value during object initialization.
@@ -465,6 +1486,111 @@ class Graph(object):
         nodeData = self.nodeData(node, self.rootDataStore)
         nodeData._value = value
         nodeData._flags |= (NodeData.FIXED|NodeData.VALID)
+        self._mutations += 1
+
+    def hydrate(self, objs, hydrator):
+        """Has the hydrator supply the stored values of the objects
+        lazily, the first time each is read.
+
+        When a node of one of the objects is read and has no valid
+        value, hydrator.hydrate(node) is called before the node is
+        computed; it may set the node's value, and those of any
+        other nodes, with nodeHydrate, and returns True if it set
+        the node's.  Otherwise the node is computed as usual.
+
+        """
+        with self._lock:
+            for obj in objs:
+                self._hydrators[obj] = hydrator
+
+    def checkpoint(self, path, store):
+        """Writes the graph's nodes, edges and valid root values to
+        the file at path, identifying objects by their ids in the
+        nodesdb.ObjectStore store.  See nodesdb.checkpoint.
+
+        """
+        from nodesdb import checkpoint
+        return checkpoint.checkpoint(path, store, graph=self)
+
+    def restore(self, path, store):
+        """Restores a checkpoint written by checkpoint, loading its
+        objects from store; its values are paged in lazily.  See
+        nodesdb.checkpoint.
+
+        """
+        from nodesdb import checkpoint
+        return checkpoint.restore(path, store, graph=self)
+
+    def page(self, pages, pager):
+        """Has the pager supply the values of nodes in the root data
+        store, the first time each is read.
+
+        pages is a list of (node, fixed) pairs, fixed telling whether
+        the node's value was set rather than computed.  When one of
+        the nodes is read, pager.page(node) is called for its value.
+        Until then the value is pending: setting the node, or
+        invalidating it by changing anything upstream of it, discards
+        it, just as it would discard a value already paged in.  Nodes
+        with a valid value already are skipped.
+
+        """
+        with self._lock:
+            for node, fixed in pages:
+                nodeData = self._rootDataStore._nodeDataByNodeId.get(node._id)
+                if nodeData is None or not nodeData._flags & (NodeData.VALID|NodeData.FIXED):
+                    self._paged[node._id] = (pager, fixed)
+
+    def nodeHydrate(self, node, value, fixed=True):
+        """Sets a value supplied by a hydrator or pager in the root
+        data store, unless the node already has a valid or set
+        value there.
+
+        Nothing can have read the node before it is hydrated, so
+        nothing is invalidated.  Returns True if the value was set.
+
+        """
+        with self._lock:
+            nodeData = self._rootDataStore.nodeData(node, searchParent=False)
+            if nodeData._flags & (NodeData.VALID|NodeData.FIXED):
+                return False
+            nodeData._value = value
+            nodeData._flags |= (NodeData.FIXED|NodeData.VALID) if fixed else NodeData.VALID
+            return True
+
+    def nodeFixedData(self, descriptor, args=(), dataStore=None):
+        """Returns the NodeData of the value set on the node of the
+        bound descriptor, as seen from the data store, or None if no
+        value is set.
+
+        A value a hydrator or pager has yet to supply is supplied
+        first, so a value never read is still found; the node is
+        created for this if need be, but not otherwise.
+
+        """
+        dataStore = dataStore or self.activeDataStore
+        hydrating = bool(self._hydrators) and descriptor.obj in self._hydrators
+        node = self.nodeResolve(descriptor, args=args, createIfMissing=hydrating)
+        if node is None:
+            return None
+        if self._paged or self._hydrators:
+            self._nodeHydrate(node)
+        nodeData = dataStore.nodeData(node, createIfMissing=False)
+        if nodeData is None or not nodeData._flags & NodeData.FIXED:
+            return None
+        return nodeData
+
+    def _nodeHydrate(self, node):
+        if self._paged:
+            with self._lock:
+                paged = self._paged.pop(node._id, None)
+            if paged is not None:
+                pager, fixed = paged
+                return self.nodeHydrate(node, pager.page(node), fixed=fixed)
+        if type(node._descriptor._obj) is not weakref.ref:
+            return False
+        obj = node._descriptor._obj()
+        hydrator = self._hydrators.get(obj) if obj is not None else None
+        return hydrator is not None and hydrator.hydrate(node)
 
     def nodeSetValue(self, node, value, dataStore=None, callDelegate=True):
         if self.computing:
@@ -478,13 +1604,17 @@ class Graph(object):
             self.nodeClearValue(node, dataStore=dataStore, callDelegate=callDelegate)
             return
         dataStore = dataStore or self.activeDataStore
+        if self._state._batch is not None:
+            self._state._batch._nodeSet(node, value, dataStore)
+            return
         nodeData = self.nodeData(node, dataStore=dataStore, searchParent=False)
         if nodeData.fixed and nodeData.value == value:  # No change.
             return
         nodeData._value = value
         nodeData._flags |= (NodeData.FIXED|NodeData.VALID)
-        self.nodeInvalidateOutputs(node, dataStore=dataStore)
+        invalidated = self.nodeInvalidateOutputs(node, dataStore=dataStore)
         self.onNodeChanged(node)
+        self._nodesPush(invalidated | set([node]), dataStore)
 
     def nodeClearValue(self, node, dataStore=None, callDelegate=True):
         if self.computing:
@@ -495,13 +1625,18 @@ class Graph(object):
         if not node.settable:
             raise RuntimeError("This is not a settable node.")
         dataStore = dataStore or self.activeDataStore
+        if self._paged or self._hydrators:
+            self._nodeHydrate(node)     # So that a pending value cannot come back once cleared.
+        if self._state._batch is not None:
+            self._state._batch._nodeClear(node, dataStore)
+            return
         nodeData = self.nodeData(node, dataStore=dataStore, createIfMissing=False, searchParent=False)
         if not nodeData or not nodeData.fixed:
             raise RuntimeError("You cannot clear a value that hasn't been set.")
-        if node.key in dataStore._nodeDataByNodeKey:
-            del dataStore._nodeDataByNodeKey[node.key]
-        self.nodeInvalidateOutputs(node, dataStore=dataStore)
+        dataStore._nodeDataDelete(node)
+        invalidated = self.nodeInvalidateOutputs(node, dataStore=dataStore)
         self.onNodeChanged(node)
+        self._nodesPush(invalidated | set([node]), dataStore)
 
     def nodeSetWhatIf(self, node, value, dataStore=None):
         if self.computing:
@@ -511,6 +1646,9 @@ class Graph(object):
         dataStore = dataStore or self.activeDataStore
         if not isinstance(dataStore, Scenario):
             raise RuntimeError("You cannot use a what-if outside of a scenario.")
+        if self._state._batch is not None:
+            self._state._batch._nodeSet(node, value, dataStore, notify=False)
+            return
         nodeData = self.nodeData(node, dataStore=dataStore, searchParent=False)
         if nodeData.fixed and nodeData.value == value:  # No change.
             return
@@ -526,42 +1664,211 @@ class Graph(object):
         dataStore = dataStore or self.activeDataStore
         if not isinstance(dataStore, Scenario):
             raise RuntimeError("You cannot use a what-if outside of a scenario.")
+        if self._state._batch is not None:
+            self._state._batch._nodeClear(node, dataStore, notify=False)
+            return
         nodeData = self.nodeData(node, dataStore=dataStore, createIfMissing=False, searchParent=False)
         if not nodeData or not nodeData.fixed:
             raise RuntimeError("You cannot clear a value that hasn't been set.")
-        if node.key in dataStore._nodeDataByNodeKey:
-            del dataStore._nodeDataByNodeKey[node.key]
+        dataStore._nodeDataDelete(node)
         self.nodeInvalidateOutputs(node, dataStore=dataStore)
 
     def nodeInvalidateOutputs(self, node, dataStore=None):
-        dataStore = dataStore or self.activeDataStore
-        outputs = list(node._outputNodes)
+        return self.nodesInvalidateOutputs([node], dataStore=dataStore)
+
+    def nodesInvalidateOutputs(self, nodes, dataStore=None):
+        """Invalidates everything downstream of the given nodes
+        in a single pass.
+
+        Each downstream node is visited at most once, however many
+        paths lead to it, and the sweep stops at fixed nodes.
+        Subscribers are notified once per invalidated node after
+        the sweep completes.
+
+        Returns the set of nodes invalidated.
+
+        """
+        invalidated = self._nodesInvalidateOutputs(nodes, dataStore=dataStore)
+        self.onNodesInvalidated(invalidated)
+        return invalidated
+
+    def _nodesInvalidateOutputs(self, nodes, dataStore=None):
+        """Invalidates everything downstream of the nodes in the
+        data store and in every data store active above it, in any
+        thread, since values computed there may have read the
+        changed nodes.
+
+        """
+        with self._lock:
+            self._mutations += 1
+            self._invalidations += 1
+            self._sweeping += 1
+            revision = self._mutations
+            activeScenarios = list(self._activeScenarios)
+        try:
+            dataStore = dataStore or self.activeDataStore
+            if self._paged and dataStore is self._rootDataStore:
+                for node in nodes:
+                    self._paged.pop(node._id, None)
+            if self.earlyCutoff:
+                stamps = dataStore._stamps
+                for node in nodes:
+                    if node._id in dataStore._nodeDataByNodeId:
+                        stamps[node._id] = (revision, revision)
+                    else:
+                        stamps.pop(node._id, None)
+            invalidated = self._nodesSweepOutputs(nodes, dataStore)
+            for upperDataStore in activeScenarios:
+                parentDataStore = upperDataStore._activeParentDataStore
+                while parentDataStore is not None and parentDataStore is not dataStore:
+                    parentDataStore = parentDataStore._activeParentDataStore
+                if parentDataStore is not None:
+                    invalidated |= self._nodesSweepOutputs(nodes, upperDataStore)
+        finally:
+            # Counted again once the sweep is done, so that nothing
+            # computed while it was under way is kept.
+            with self._lock:
+                self._invalidations += 1
+                self._sweeping -= 1
+        if self.profiler is not None:
+            self.profiler._invalidated(invalidated)
+        return invalidated
+
+    def _nodesSweepOutputs(self, nodes, dataStore, invalidate=True):
+        """Visits everything downstream of the nodes once, stopping
+        at fixed nodes.
+
+        Valid data found in a parent of the data store is shadowed
+        by invalid data in the data store itself, and if invalidate
+        is set, valid data in the data store is invalidated.
+
+        Returns the set of nodes invalidated.
+
+        """
+        visited = set(nodes)
+        outputs = []
+        for node in visited:
+            outputs.extend(node._outputNodes)
         invalidated = set()
         while outputs:
             output = outputs.pop()
-            outputData = self.nodeData(output, dataStore=dataStore, createIfMissing=False)
-            if outputData and outputData.fixed:
+            if output in visited:
                 continue
-            if outputData and outputData.dataStore != dataStore:
-                outputData = self.nodeData(output, dataStore=dataStore, searchParent=False)
-            if outputData and outputData.valid:
-                outputData._flags &= ~NodeData.VALID
-                del outputData._value
-                invalidated.add(output)
-            outputs.extend(list(output._outputNodes))
-        for invalid in invalidated:
-            self.onNodeInvalidated(invalid)
+            visited.add(output)
+            outputData = dataStore.nodeData(output, createIfMissing=False)
+            paged = self._paged.get(output._id) if self._paged else None
+            if paged is not None:
+                # A pending value is discarded in the root, whether or
+                # not the node has NodeData there, and shadowed above.
+                if paged[1]:
+                    continue
+                if dataStore is self._rootDataStore:
+                    self._paged.pop(output._id, None)
+                elif outputData is None or outputData._dataStore is not dataStore:
+                    outputData = dataStore.nodeData(output, searchParent=False)
+            if outputData:
+                if outputData._flags & NodeData.FIXED:
+                    continue
+                if outputData._dataStore is not dataStore:
+                    if outputData._flags & NodeData.VALID:
+                        dataStore.nodeData(output, searchParent=False)
+                elif invalidate and outputData._flags & NodeData.VALID:
+                    # The old value is left in place: another thread
+                    # may have seen the flag and be about to read it.
+                    if self.earlyCutoff:
+                        outputData._flags = (outputData._flags & ~NodeData.VALID) | NodeData.DIRTY
+                    else:
+                        outputData._flags &= ~NodeData.VALID
+                    invalidated.add(output)
+            outputs.extend(output._outputNodes)
         return invalidated
 
-    def onNodeChanged(self, node):
-        for subscription in self._state._subscriptionsByNodeKey[node.key]:
+    def batch(self):
+        """Returns a context manager that collects sets and clears
+        and applies them together on exit.
+
+        See GraphBatch.
+
+        """
+        return GraphBatch(self)
+
+    def _nodesPush(self, nodes, dataStore):
+        """Recomputes those of the changed or invalidated nodes that
+        have push subscriptions, and delivers their values.
+
+        The nodes are recomputed in topological order, so a
+        subscriber to a node is called before subscribers to nodes
+        depending on it, and intermediate nodes shared between them
+        are computed once.  A node that fails to compute is logged
+        and skipped.
+
+        """
+        pushed = self._subscriptions.pushed(nodes)
+        if not pushed:
+            return
+        order = []
+        visited = set()
+        for node in pushed:
+            work = [(node, False)]
+            while work:
+                node, done = work.pop()
+                if done:
+                    order.append(node)
+                    continue
+                if node in visited:
+                    continue
+                visited.add(node)
+                work.append((node, True))
+                work.extend((input, False) for input in node._inputNodes if input in nodes and input not in visited)
+        for node in order:
+            subscriptions = self._subscriptions.pushSubscriptions(node._id)
+            if not subscriptions:
+                continue
+            try:
+                value = self.nodeValue(node, dataStore=dataStore)
+            except Exception:
+                logging.exception("Could not compute %s.%s for its subscribers." % (node.typename, node.name))
+                continue
+            for subscription in list(subscriptions):
+                subscription.notify(value)
+
+    def onNodesChanged(self, nodes):
+        """Notifies each subscription to any of the nodes once."""
+        for subscription in self._subscriptions.pullSubscriptions(nodes):
             subscription.notify()
 
-    def onNodeInvalidated(self, node):
-        for subscription in self._state._subscriptionsByNodeKey[node.key]:
+    def onNodesInvalidated(self, nodes):
+        """Notifies each subscription to any of the nodes once, then
+        calls onNodeInvalidated once for each node if a subclass
+        overrides it.
+
+        """
+        for subscription in self._subscriptions.pullSubscriptions(nodes):
             subscription.notify()
+        onNodeInvalidated = self.onNodeInvalidated
+        if getattr(onNodeInvalidated, 'im_func', None) is not Graph.onNodeInvalidated.im_func:
+            for node in nodes:
+                onNodeInvalidated(node)
+
+    def onNodeChanged(self, node):
+        self.onNodesChanged((node,))
+
+    def onNodeInvalidated(self, node):
+        """Called by onNodesInvalidated for each node invalidated, after
+        the subscriptions have been notified.  Does nothing here, and
+        is only called at all when overridden.
+
+        """
 
 class GraphDataStore(object):
+    """Holds node data.
+
+    A data store only ever modifies NodeData it owns.  NodeData
+    shared with another store (see Scenario.copy) is copied into
+    this store the first time it is fetched for writing, i.e. with
+    createIfMissing set.
+
+    """
 
     _nextID = 0
 
@@ -569,8 +1876,12 @@ class GraphDataStore(object):
         self._id = GraphDataStore._nextID
         GraphDataStore._nextID += 1
         self._graph = graph
-        self._nodeDataByNodeKey = {}
+        graph._dataStores.add(self)
+        self._nodeDataByNodeId = {}
+        self._stamps = {}               # Node id -> (changed, verified) revisions; see Graph.earlyCutoff.
         self._activeParentDataStore = None
+        self._activeStack = None        # The stack and overlay of the thread
+        self._activeOverlay = None      # this data store is active in.
 
     @property
     def graph(self):
@@ -583,59 +1894,283 @@ class GraphDataStore(object):
         If no data is found, and createIfMissing is True, creates
         a new NodeData object in the this data store.
 
+        When this is the active data store, its parents are found
+        through the graph's overlay index in constant time however
+        deeply scenarios are nested; otherwise they are walked.
+
         """
-        nodeData = self._nodeDataByNodeKey.get(node.key)
-        if nodeData is None and searchParent:
-            dataStore = self._activeParentDataStore
-            while dataStore:
-                nodeData = dataStore._nodeDataByNodeKey.get(node.key)
-                if nodeData:
-                    break
-                dataStore = dataStore._activeParentDataStore
+        nodeId = node._id
+        nodeData = self._nodeDataByNodeId.get(nodeId)
+        if nodeData is not None:
+            if createIfMissing and nodeData._dataStore is not self:
+                nodeData = self._nodeDataCopy(nodeData)
+            return nodeData
+        if searchParent and self._activeParentDataStore is not None:
+            overlay = self._activeOverlay
+            stack = self._activeStack
+            if overlay is not None and stack[-1] is self:
+                nodeData = overlay.get(nodeId)
+                if nodeData is None:
+                    nodeData = stack[0]._nodeDataByNodeId.get(nodeId)
+            else:
+                dataStore = self._activeParentDataStore
+                while dataStore:
+                    nodeData = dataStore._nodeDataByNodeId.get(nodeId)
+                    if nodeData:
+                        break
+                    dataStore = dataStore._activeParentDataStore
         if not nodeData and createIfMissing:
-            nodeData = self._nodeDataByNodeKey[node.key] = NodeData(node, self)
+            nodeData = NodeData(node, self)
+            self._nodeDataSet(nodeData)
+        return nodeData
+
+    def _nodeDataCopy(self, nodeData):
+        copy = NodeData(nodeData._node, self)
+        copy._flags = nodeData._flags
+        copy._value = nodeData._value
+        self._nodeDataSet(copy)
+        return copy
+
+    def _nodeDataSet(self, nodeData):
+        nodeId = nodeData._node._id
+        self._nodeDataByNodeId[nodeId] = nodeData
+        if self._activeParentDataStore is not None:
+            self._graph._overlayUpdate(self, nodeId)
+
+    def _nodeDataDelete(self, node):
+        nodeData = self._nodeDataByNodeId.pop(node._id, None)
+        if self._stamps:
+            self._stamps.pop(node._id, None)
+        if nodeData is not None and self._activeParentDataStore is not None:
+            self._graph._overlayUpdate(self, node._id)
         return nodeData
 
 class Scenario(GraphDataStore):
+    """A data store for what-ifs, layered over whichever data store
+    is active when the scenario is entered.
+
+    Values computed in a scenario are kept when it is exited.  If
+    nothing in the graph has been set or cleared by the time it is
+    next entered over the same data stores, they are reused;
+    otherwise they are dropped and the what-ifs applied again.
+
+    """
+    def __init__(self, graph):
+        GraphDataStore.__init__(self, graph)
+        self._exitDataStores = None
+        self._exitMutations = None
+        self._whatIfs = None        # (graph mutations, what-ifs) when last listed.
 
     def whatIfs(self):
-        return [nodeData for nodeData in self._nodeDataByNodeKey.values() if nodeData.fixed]
+        """Returns a tuple of the NodeData of the what-ifs set in this
+        scenario.
+
+        The tuple is kept until a what-if is set or cleared, so
+        listing it again is cheap however many values the scenario
+        has computed.
+
+        """
+        whatIfs = self._whatIfs
+        if whatIfs is None or whatIfs[0] != self.graph._mutations:
+            whatIfs = self._whatIfs = (self.graph._mutations,
+                                       tuple(nodeData for nodeData in self._nodeDataByNodeId.itervalues() if nodeData._flags & NodeData.FIXED))
+        return whatIfs[1]
 
     def activeWhatIfs(self):
-        whatIfsByNodeKey = {}
+        """Returns the NodeData of the what-ifs in effect while this
+        scenario is active: its own, and those of the scenarios it is
+        nested in that it does not override.
+
+        """
+        whatIfsByNodeId = {}
         dataStore = self
-        while dataStore is not None:
+        while isinstance(dataStore, Scenario):
             for whatIf in dataStore.whatIfs():
-                if whatIf.nodeKey in whatIfsByNodeKey:
-                    continue
-                whatIfsByNodeKey[whatIf.nodeKey] = whatIf
+                whatIfsByNodeId.setdefault(whatIf._node._id, whatIf)
             dataStore = dataStore._activeParentDataStore
-        return whatIfsByNodeKey.values()
+        return whatIfsByNodeId.values()
 
-    def cleanup(self):
-        for nodeKey, nodeData in self._nodeDataByNodeKey.items():
-            if nodeData.fixed:
-                continue
-            del self._nodeDataByNodeKey[nodeKey]
+    def copy(self):
+        """Returns a new scenario with the same what-ifs.
+
+        The what-ifs' NodeData are shared between the two scenarios
+        until either one changes them.
+
+        """
+        scenario = self.__class__(self.graph)
+        scenario._nodeDataByNodeId = dict((nodeId, nodeData) for nodeId, nodeData in self._nodeDataByNodeId.iteritems() if nodeData.fixed)
+        return scenario
 
-    def _applyWhatIfs(self):
-        for whatIf in self.whatIfs():
-            self.graph.nodeInvalidateOutputs(whatIf.node, self)
+    def cleanup(self):
+        """Drops everything but the what-ifs from this scenario."""
+        self._nodeDataByNodeId = dict((nodeId, nodeData) for nodeId, nodeData in self._nodeDataByNodeId.iteritems() if nodeData.fixed)
+        self._stamps = dict((nodeId, stamp) for nodeId, stamp in self._stamps.iteritems() if nodeId in self._nodeDataByNodeId)
+        self._exitDataStores = None
+        if self._activeParentDataStore is not None:
+            self.graph._overlayRebuild(self)
+
+    def _applyWhatIfs(self, invalidate=True):
+        graph = self.graph
+        whatIfNodes = [whatIf.node for whatIf in self.whatIfs()]
+        graph.onNodesInvalidated(graph._nodesSweepOutputs(whatIfNodes, self, invalidate=invalidate))
 
     def __enter__(self):
-        if self in self.graph.activeDataStores:
+        graph = self.graph
+        if self._activeParentDataStore is not None:
             raise RuntimeError("You cannot reenter an active data store.")
-        self._activeParentDataStore = self.graph.activeDataStorePush(self)
-        self._applyWhatIfs()
+        stale = (self._exitDataStores != tuple(graph.activeDataStores)
+                 or self._exitMutations != graph._mutations)
+        if stale:
+            self.cleanup()
+        self._activeParentDataStore = graph.activeDataStorePush(self)
+        # Even when this scenario's own values are reusable, a parent
+        # may since have computed values downstream of the what-ifs,
+        # which need to be shadowed here.
+        self._applyWhatIfs(invalidate=stale)
         return self
 
     def __exit__(self, *args):
-        self.cleanup()
-        self.graph.activeDataStorePop()
+        graph = self.graph
+        graph.activeDataStorePop()
         self._activeParentDataStore = None
+        self._exitDataStores = tuple(graph.activeDataStores)
+        self._exitMutations = graph._mutations
+
+    def _nodeDataSet(self, nodeData):
+        if nodeData._flags & NodeData.FIXED:
+            self._whatIfs = None
+        GraphDataStore._nodeDataSet(self, nodeData)
+
+    def _nodeDataDelete(self, node):
+        nodeData = GraphDataStore._nodeDataDelete(self, node)
+        if nodeData is not None and nodeData._flags & NodeData.FIXED:
+            self._whatIfs = None
+        return nodeData
+
+    def diff(self, nodes, base=None):
+        """Returns a ScenarioDiff of the nodes' values in this scenario
+        against those in base, another scenario, or in the active data
+        store if base is None.  Scenarios are entered over the active
+        data store to be read, so neither may be active already.
+
+        The nodes are computed in base first, which records their
+        inputs.  Only those downstream of a what-if that differs
+        between the two are then computed in this scenario and
+        compared; any other node reads the same inputs in both, and
+        so has the same value.
+
+        """
+        graph = self.graph
+        if graph.computing:
+            raise RuntimeError("You cannot diff scenarios while the graph is updating its state.")
+        nodes = list(nodes)
+        if base is None:
+            baseValues = [graph.nodeValue(node) for node in nodes]
+            baseWhatIfs = {}
+        else:
+            with base:
+                baseValues = [graph.nodeValue(node) for node in nodes]
+            baseWhatIfs = dict((whatIf._node._id, whatIf) for whatIf in base.whatIfs())
+        whatIfs = dict((whatIf._node._id, whatIf) for whatIf in self.whatIfs())
+
+        changes = []
+        for nodeId, whatIf in whatIfs.iteritems():
+            other = baseWhatIfs.get(nodeId)
+            if other is None or not _valuesEqual(whatIf._node, other._value, whatIf._value):
+                changes.append((whatIf._node, whatIf._value))
+        for nodeId, other in baseWhatIfs.iteritems():
+            if nodeId not in whatIfs:
+                changes.append((other._node, CLEAR))
+
+        # The sweep stops where both sides hold the same set value:
+        # at what-ifs they share, and at values set in the data store
+        # both are entered over.
+        dataStore = graph.activeDataStore
+        closure = set(node for node, value in changes)
+        work = list(closure)
+        while work:
+            for output in tuple(work.pop()._outputNodes):
+                if output in closure or output._id in whatIfs or output._id in baseWhatIfs:
+                    continue
+                outputData = dataStore.nodeData(output, createIfMissing=False)
+                if outputData and outputData._flags & NodeData.FIXED:
+                    continue
+                closure.add(output)
+                work.append(output)
+
+        changed = {}
+        if any(node in closure for node in nodes):
+            with self:
+                for node, baseValue in zip(nodes, baseValues):
+                    if node in closure:
+                        value = graph.nodeValue(node)
+                        if not _valuesEqual(node, baseValue, value):
+                            changed[node] = (baseValue, value)
+        return ScenarioDiff(graph, changes, changed)
+
+
+def _valuesEqual(node, value, other):
+    equals = node._descriptor._descriptor._equals
+    try:
+        return bool(equals(value, other) if equals else value == other)
+    except Exception:
+        return False
+
+
+class ScenarioDiff(object):
+    """The difference between a scenario and its base, returned by
+    Scenario.diff.
+
+    whatIfs lists the (node, value) what-ifs that differ, value being
+    CLEAR for a what-if only the base has, and changed maps each node
+    whose value differs to its (base value, value).  Replaying the
+    what-ifs into a copy of the base reproduces the scenario;
+    nodesdb.codec.dumpScenarioDiff persists a diff.
+
+    """
+    def __init__(self, graph, whatIfs, changed):
+        self._graph = graph
+        self._whatIfs = whatIfs
+        self._changed = changed
+
+    @property
+    def graph(self):
+        return self._graph
+
+    @property
+    def whatIfs(self):
+        return self._whatIfs
+
+    @property
+    def changed(self):
+        return self._changed
+
+    def __len__(self):
+        return len(self._changed)
+
+    def replay(self, scenario=None):
+        """Sets the what-ifs in the scenario, a new one by default,
+        in one batch, and returns the scenario.
+
+        """
+        graph = self._graph
+        scenario = scenario or Scenario(graph)
+        with graph.batch():
+            for node, value in self._whatIfs:
+                if value is CLEAR:
+                    graph.nodeClearWhatIf(node, dataStore=scenario)
+                else:
+                    graph.nodeSetWhatIf(node, value, dataStore=scenario)
+        return scenario
 
 
 def scenario():
     return Scenario(_graph)
 
+def batch():
+    return _graph.batch()
+
+def values(nodes):
+    return _graph.nodeValues(nodes)
+
 _graph = Graph()        # We need somewhere to start.
@@ -0,0 +1,159 @@
+"""Walks and exports the dependency graph recorded between nodes.
+
+Every node keeps its inputs and outputs, as found while computing
+it, so the graph holds the full dynamic dependency DAG.  The
+functions here count it, summarize it by graph method, follow it
+upstream or downstream of a node, and write it out as DOT or as an
+edge list.
+
+All of them visit the nodes in place rather than copying the node
+table or collecting the edges first, so they scale to graphs with
+millions of edges; for the same reason they must not run while
+another thread is adding nodes to the graph.
+
+"""
+import array
+import collections
+import heapq
+
+from graph import _graph
+
+
+_MAX_UINT = 2 ** (8 * array.array('I').itemsize) - 1
+
+
+def methodLabel(node):
+    """Returns 'Class.method' for the node."""
+    return '%s.%s' % (node.typename, node.name)
+
+def nodeLabel(node):
+    """Returns 'Class.method(args)' for the node."""
+    return '%s(%s)' % (methodLabel(node), ', '.join(repr(arg) for arg in node.args))
+
+def iterNodes(graph=None):
+    return (graph or _graph)._nodesById.itervalues()
+
+def iterEdges(graph=None):
+    """Yields (input, output) pairs of nodes, one per edge."""
+    for node in iterNodes(graph):
+        for output in node._outputNodes:
+            yield node, output
+
+def nodeCount(graph=None):
+    return len((graph or _graph)._nodesById)
+
+def edgeCount(graph=None):
+    return sum(len(node._outputNodes) for node in iterNodes(graph))
+
+def methodCounts(graph=None):
+    """Returns a dict of the number of nodes by 'Class.method'."""
+    counts = collections.defaultdict(int)
+    for node in iterNodes(graph):
+        counts[methodLabel(node)] += 1
+    return dict(counts)
+
+def fanInHistogram(graph=None):
+    """Returns, by 'Class.method', a dict of the number of nodes by
+    their number of inputs.
+
+    """
+    return _histogram(graph, '_inputNodes')
+
+def fanOutHistogram(graph=None):
+    """Returns, by 'Class.method', a dict of the number of nodes by
+    their number of outputs.
+
+    """
+    return _histogram(graph, '_outputNodes')
+
+def _histogram(graph, edges):
+    histograms = collections.defaultdict(lambda: collections.defaultdict(int))
+    for node in iterNodes(graph):
+        histograms[methodLabel(node)][len(getattr(node, edges))] += 1
+    return dict((label, dict(histogram)) for label, histogram in histograms.iteritems())
+
+def hubs(limit=10, graph=None):
+    """Returns the limit nodes with the most outputs, most first.
+
+    These are the nodes whose changes invalidate the most.
+
+    """
+    return heapq.nlargest(limit, iterNodes(graph), key=lambda node: len(node._outputNodes))
+
+def upstream(node):
+    """Returns the set of nodes the node depends on, directly or
+    indirectly.
+
+    """
+    return _closure(node, '_inputNodes')
+
+def downstream(node):
+    """Returns the set of nodes depending on the node, directly or
+    indirectly, i.e. everything a change to it can invalidate.
+
+    """
+    return _closure(node, '_outputNodes')
+
+def _closure(node, edges):
+    closure = set()
+    work = list(getattr(node, edges))
+    while work:
+        node = work.pop()
+        if node in closure:
+            continue
+        closure.add(node)
+        work.extend(getattr(node, edges))
+    return closure
+
+def writeDot(f, graph=None, nodes=None):
+    """Writes the graph, or just the given nodes and the edges
+    between them, to the file f in Graphviz DOT format.
+
+    """
+    if nodes is not None:
+        nodes = set(nodes)
+    f.write('digraph nodes {\n')
+    for node in (nodes if nodes is not None else iterNodes(graph)):
+        f.write('    n%d [label="%s"];\n' % (node._id, nodeLabel(node).replace('\\', '\\\\').replace('"', '\\"')))
+    for node in (nodes if nodes is not None else iterNodes(graph)):
+        for output in node._outputNodes:
+            if nodes is None or output in nodes:
+                f.write('    n%d -> n%d;\n' % (node._id, output._id))
+    f.write('}\n')
+
+def writeEdgeList(f, graph=None):
+    """Writes one 'input id<TAB>output id' line per edge to the file f.
+
+    Node ids are those of Node.id; see writeNodeList.
+
+    """
+    for node in iterNodes(graph):
+        nodeId = node._id
+        for output in node._outputNodes:
+            f.write('%d\t%d\n' % (nodeId, output._id))
+
+def writeNodeList(f, graph=None):
+    """Writes one 'id<TAB>Class.method<TAB>args' line per node to the
+    file f.
+
+    """
+    for node in iterNodes(graph):
+        f.write('%d\t%s\t%r\n' % (node._id, methodLabel(node), node.args))
+
+def edgeArrays(graph=None):
+    """Returns the edges as two columns, arrays of input and output
+    node ids.  Ids are stored as unsigned ints, eight bytes an edge,
+    until the graph has handed out more ids than an unsigned int
+    holds, and as unsigned longs after that.
+
+    """
+    graph = graph or _graph
+    typecode = 'I' if graph._nextNodeId <= _MAX_UINT else 'L'
+    inputs = array.array(typecode)
+    outputs = array.array(typecode)
+    for node in iterNodes(graph):
+        nodeId = node._id
+        for output in node._outputNodes:
+            inputs.append(nodeId)
+            outputs.append(output._id)
+    return inputs, outputs
@@ -0,0 +1,63 @@
+"""Evaluates nodes under many independent scenarios in parallel.
+
+The graph is shipped to the worker processes once, by forking them
+after the base values have been computed, so every worker starts
+with the base graph already in memory and shares its pages with the
+parent until it writes to them.  Each scenario is then identified to
+a worker only by its index.
+
+"""
+import multiprocessing
+
+from graph import Scenario, _graph
+
+_job = None     # (graph, whatIfSets, nodes), inherited by forked workers.
+
+
+def _scenarioValues(index):
+    graph, whatIfSets, nodes = _job
+    with Scenario(graph):
+        for change in whatIfSets[index]:
+            graph.nodeSetWhatIf(change.node, change.value)
+        return [graph.nodeValue(node) for node in nodes]
+
+
+def scenarioValues(whatIfSets, nodes, processes=None, graph=None, warm=True):
+    """Returns the values of nodes under each set of what-ifs.
+
+    whatIfSets is a list of lists of NodeChange objects, each list
+    describing one scenario; nodes is a list of nodes.  The result
+    is a list holding, for each scenario, the list of node values
+    in the same order as nodes.  Values are returned from the worker
+    processes by pickling, so they must be picklable.
+
+    If warm is set, nodes are first computed in the base graph, so
+    that whatever the what-ifs do not affect is computed once and
+    shared by every worker.  With processes=1 the scenarios are
+    evaluated serially in this process.
+
+    """
+    global _job
+    graph = graph or _graph
+    if graph.computing:
+        raise RuntimeError("You cannot evaluate scenarios while the graph is updating its state.")
+    if graph._state._batch is not None:
+        raise RuntimeError("You cannot evaluate scenarios inside a batch.")
+    if warm:
+        for node in nodes:
+            graph.nodeValue(node)
+    whatIfSets = list(whatIfSets)
+    _job = (graph, whatIfSets, list(nodes))
+    try:
+        processes = processes or multiprocessing.cpu_count()
+        if processes == 1 or len(whatIfSets) < 2:
+            return map(_scenarioValues, xrange(len(whatIfSets)))
+        pool = multiprocessing.Pool(min(processes, len(whatIfSets)))
+        try:
+            chunksize = max(1, len(whatIfSets) // (processes * 4))
+            return pool.map(_scenarioValues, xrange(len(whatIfSets)), chunksize)
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        _job = None
@@ -0,0 +1,261 @@
+"""Profiles the computations a graph performs.
+
+A GraphProfiler attached to a graph records, for every node and for
+every graph method (class and method name together), how many times
+it was computed, how often a valid value was read instead, how often
+it was invalidated, and the wall time spent computing it, both
+inclusive and exclusive of the inputs it computed along the way:
+
+    with nodes.GraphProfiler() as profiler:
+        book.Value()
+    print profiler.report()
+
+Besides the text report, the dependency tree of the computations can
+be written in the folded format read by flamegraph.pl and speedscope,
+or loaded into the standard pstats module.  When no profiler is
+attached the graph only pays an attribute check per read.
+
+"""
+import pstats
+import threading
+import time
+
+from graph import _graph
+
+
+class NodeProfile(object):
+    """The counts and times recorded for a node or a graph method.
+
+    Inclusive time counts only the outermost of any recursive
+    computations of a graph method, so it is never more than the
+    wall time actually spent.
+
+    """
+    __slots__ = ('computes', 'hits', 'invalidations', 'inclusive', 'exclusive')
+
+    def __init__(self):
+        self.computes = 0
+        self.hits = 0
+        self.invalidations = 0
+        self.inclusive = 0.0
+        self.exclusive = 0.0
+
+    def __repr__(self):
+        return '<NodeProfile computes=%d hits=%d invalidations=%d inclusive=%.6f exclusive=%.6f>' % (
+            self.computes, self.hits, self.invalidations, self.inclusive, self.exclusive)
+
+
+class _CallTree(object):
+    """A graph method's computations beneath one path of callers."""
+    __slots__ = ('key', 'computes', 'inclusive', 'exclusive', 'children')
+
+    def __init__(self, key):
+        self.key = key
+        self.computes = 0
+        self.inclusive = 0.0
+        self.exclusive = 0.0
+        self.children = {}
+
+
+def _methodKey(node):
+    descriptor = node._descriptor
+    return (descriptor.obj.__class__, descriptor._descriptor)
+
+def _methodLabel(key):
+    cls, descriptor = key
+    return '%s.%s' % (cls.__name__, descriptor.name)
+
+
+class GraphProfiler(object):
+    """Records what a graph computes while it is attached.
+
+    The profiler is attached to the graph by start, or on entering
+    it as a context manager, and detached by stop.  Its records are
+    kept until clear is called, so a profiler can be attached again
+    to accumulate more.
+
+    """
+    def __init__(self, graph=None):
+        self._graph = graph or _graph
+        self._previous = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._nodeProfiles = {}
+        self._methodProfiles = {}
+        self._root = _CallTree(None)
+
+    @property
+    def graph(self):
+        return self._graph
+
+    def start(self):
+        if self._graph.profiler is self:
+            raise RuntimeError("This profiler is already attached to the graph.")
+        self._previous = self._graph.profiler
+        self._graph.profiler = self
+        return self
+
+    def stop(self):
+        if self._graph.profiler is not self:
+            raise RuntimeError("This profiler is not attached to the graph.")
+        self._graph.profiler = self._previous
+        self._previous = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def clear(self):
+        with self._lock:
+            self._nodeProfiles.clear()
+            self._methodProfiles.clear()
+            self._root = _CallTree(None)
+
+    def nodeProfiles(self):
+        """Returns a dict of NodeProfile objects by node."""
+        return dict(self._nodeProfiles)
+
+    def methodProfiles(self):
+        """Returns a dict of NodeProfile objects by 'Class.method'."""
+        profiles = {}
+        for key, profile in self._methodProfiles.items():
+            profiles[_methodLabel(key)] = profile
+        return profiles
+
+    def report(self, limit=20, sortBy='exclusive'):
+        """Returns a table of the graph methods taking the most time,
+        sorted by the given NodeProfile attribute.
+
+        """
+        profiles = sorted(self.methodProfiles().items(), key=lambda item: getattr(item[1], sortBy), reverse=True)
+        lines = ['%10s %10s %10s %12s %12s  %s' % ('computes', 'hits', 'invalid', 'inclusive', 'exclusive', 'method')]
+        for label, profile in profiles[:limit]:
+            lines.append('%10d %10d %10d %12.6f %12.6f  %s' % (
+                profile.computes, profile.hits, profile.invalidations,
+                profile.inclusive, profile.exclusive, label))
+        return '\n'.join(lines)
+
+    def folded(self):
+        """Returns the call tree as lines of 'caller;...;callee N',
+        N being the exclusive time in microseconds, as read by
+        flamegraph.pl.
+
+        """
+        lines = []
+        work = [(child, ()) for child in self._root.children.values()]
+        while work:
+            tree, path = work.pop()
+            path = path + (_methodLabel(tree.key),)
+            microseconds = int(round(tree.exclusive * 1e6))
+            if microseconds:
+                lines.append('%s %d' % (';'.join(path), microseconds))
+            work.extend((child, path) for child in tree.children.values())
+        lines.sort()
+        return lines
+
+    def writeFolded(self, path):
+        with open(path, 'w') as f:
+            for line in self.folded():
+                f.write(line + '\n')
+
+    def stats(self):
+        """Returns the records as a pstats.Stats object, with each
+        graph method in place of a function.
+
+        """
+        return pstats.Stats(_StatsSource(self))
+
+    def dumpStats(self, path):
+        self.stats().dump_stats(path)
+
+    def _hit(self, node):
+        key = _methodKey(node)
+        with self._lock:
+            self._profile(self._nodeProfiles, node).hits += 1
+            self._profile(self._methodProfiles, key).hits += 1
+
+    def _invalidated(self, nodes):
+        with self._lock:
+            for node in nodes:
+                self._profile(self._nodeProfiles, node).invalidations += 1
+                self._profile(self._methodProfiles, _methodKey(node)).invalidations += 1
+
+    def _enter(self, node):
+        local = self._local
+        stack = getattr(local, 'stack', None)
+        if stack is None:
+            stack = local.stack = []
+            local.active = {}
+        key = _methodKey(node)
+        parent = stack[-1][1] if stack else self._root
+        with self._lock:
+            tree = parent.children.get(key)
+            if tree is None:
+                tree = parent.children[key] = _CallTree(key)
+        local.active[key] = local.active.get(key, 0) + 1
+        stack.append([node, tree, time.time(), 0.0])
+
+    def _exit(self, computed):
+        now = time.time()
+        local = self._local
+        node, tree, start, children = local.stack.pop()
+        inclusive = now - start
+        exclusive = inclusive - children
+        if local.stack:
+            local.stack[-1][3] += inclusive
+        key = tree.key
+        outermost = local.active[key] == 1
+        local.active[key] -= 1
+        with self._lock:
+            nodeProfile = self._profile(self._nodeProfiles, node)
+            methodProfile = self._profile(self._methodProfiles, key)
+            for profile in (nodeProfile, methodProfile, tree):
+                profile.exclusive += exclusive
+                if computed:
+                    profile.computes += 1
+            nodeProfile.inclusive += inclusive
+            tree.inclusive += inclusive
+            if outermost:
+                methodProfile.inclusive += inclusive
+
+    @staticmethod
+    def _profile(profiles, key):
+        profile = profiles.get(key)
+        if profile is None:
+            profile = profiles[key] = NodeProfile()
+        return profile
+
+
+class _StatsSource(object):
+    """Presents a profiler's records as pstats.Stats expects of a
+    profile object.
+
+    """
+    def __init__(self, profiler):
+        self._profiler = profiler
+        self.stats = {}
+
+    def create_stats(self):
+        profiler = self._profiler
+        functions = {}
+        for key in profiler._methodProfiles:
+            function = key[1].function
+            code = getattr(function, 'func_code', None)
+            functions[key] = (code.co_filename if code else '~',
+                              code.co_firstlineno if code else 0,
+                              _methodLabel(key))
+        callers = dict((key, {}) for key in functions)
+        work = [(child, None) for child in profiler._root.children.values()]
+        while work:
+            tree, callerKey = work.pop()
+            if callerKey is not None and tree.key in callers:
+                count, _, exclusive, inclusive = callers[tree.key].get(functions[callerKey], (0, 0, 0.0, 0.0))
+                callers[tree.key][functions[callerKey]] = (
+                    count + tree.computes, count + tree.computes,
+                    exclusive + tree.exclusive, inclusive + tree.inclusive)
+            work.extend((child, tree.key) for child in tree.children.values())
+        for key, profile in profiler._methodProfiles.items():
+            self.stats[functions[key]] = (profile.computes, profile.computes,
+                                          profile.exclusive, profile.inclusive, callers[key])
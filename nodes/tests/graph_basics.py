@@ -1,5 +1,9 @@
+import StringIO
+import gc
 import nodes
 import nodes.graph
+import threading
+import time
 import unittest
 
 class GraphTestCase(unittest.TestCase):
@@ -579,5 +583,1120 @@ class GraphTestCase(unittest.TestCase):
         o.X = nodes.CLEAR
         o.Y = nodes.CLEAR
 
+    def test_iterativeEvaluation(self):
+        calls = []
+
+        class Chain(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def Base(self):
+                return 0
+
+            @nodes.graphMethod
+            def Level(self, n):
+                calls.append(n)
+                if n == 0:
+                    return self.Base()
+                return self.Level(n - 1) + 1
+
+            @nodes.graphMethod
+            def Total(self, n):
+                return sum(self.Level(i) for i in range(n))
+
+        graph = nodes.graph._graph
+        self.assertIsNone(graph.maxComputeDepth)
+        graph.maxComputeDepth = 8
+        try:
+            c = Chain()
+            self.assertEquals(c.Level(5000), 5000)
+            self.assertEquals(len(calls), 5001)     # No method is run twice.
+            self.assertEquals(c.Total(100), 4950)
+            c.Base = 10
+            del calls[:]
+            self.assertEquals(c.Level(5000), 5010)
+            self.assertEquals(len(calls), 5001)
+            self.assertEquals(c.Level(3), 13)
+            self.assertEquals(c.Total(100), 5950)
+        finally:
+            graph.maxComputeDepth = None
+
+    def test_iterativeEvaluationCycle(self):
+        class Cycle(nodes.GraphObject):
+
+            @nodes.graphMethod
+            def A(self, n):
+                return self.A((n + 1) % 10)
+
+        graph = nodes.graph._graph
+        graph.maxComputeDepth = 4
+        try:
+            self.assertRaises(RuntimeError, Cycle().A, 0)
+            self.assertFalse(graph.computing)
+        finally:
+            graph.maxComputeDepth = None
+
+    def test_compactNodes(self):
+        class Compact(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def Input(self, n):
+                return n
+
+            @nodes.graphMethod
+            def Total(self, n):
+                return sum(self.Input(i) for i in range(n))
+
+        c = Compact()
+        self.assertEquals(c.Total(3), 3)
+        self.assertEquals(c.Total(20), 190)
+        node = c.Total.node(args=(3,))
+        self.assertFalse(hasattr(node, '__dict__'))
+        self.assertFalse(hasattr(c.Input.node(args=(0,)), '__dict__'))
+        self.assertIsInstance(node._inputNodes, tuple)
+        self.assertEquals(len(node._inputNodes), 3)
+        self.assertIsInstance(c.Total.node(args=(20,))._inputNodes, set)
+        self.assertEquals(len(c.Total.node(args=(20,))._inputNodes), 20)
+        self.assertEquals(c.Input.node(args=(0,))._outputNodes,
+                          (c.Total.node(args=(3,)), c.Total.node(args=(20,))))
+
+        c.Input.setValue(10, 0)
+        self.assertEquals(c.Total(3), 13)
+        self.assertEquals(c.Total(20), 200)
+
+    def test_nodeIds(self):
+        class Ids(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def X(self):
+                return 'x'
+
+            @nodes.graphMethod
+            def Y(self, n):
+                return self.X() * n
+
+        graph = nodes.graph._graph
+        o = Ids()
+        x = o.X.node()
+        y1 = o.Y.node(args=(1,))
+        y2 = o.Y.node(args=(2,))
+        self.assertIs(o.X.node(), x)
+        self.assertEquals(len(set([x.id, y1.id, y2.id])), 3)
+        self.assertEquals(y2.id, y1.id + 1)
+        self.assertIs(graph.nodeFromId(y1.id), y1)
+        self.assertIsNone(graph.nodeFromId(-1))
+
+        self.assertEquals(o.Y(2), 'xx')
+        self.assertIs(graph.rootDataStore._nodeDataByNodeId[y2.id].node, y2)
+        o.X = 'z'
+        self.assertEquals(o.Y(2), 'zz')
+        o.X.clearValue()
+        self.assertNotIn(x.id, graph.rootDataStore._nodeDataByNodeId)
+
+    def test_nodeCache(self):
+        class Cached(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def X(self):
+                return 1
+
+            @nodes.graphMethod
+            def Y(self, n):
+                return self.X() + n
+
+            @nodes.graphMethod
+            def Z(self):
+                return self.Y(1) + self.Y(2)
+
+        graph = nodes.graph._graph
+        o = Cached()
+        self.assertEquals(o.Z(), 5)
+        x = o.X.node()
+        y = o.Y.node((1,))
+        self.assertIs(o.X.node(), x)
+        self.assertIs(o.Y.node((1,)), y)
+        self.assertIs(graph.nodeResolve(o.Y, args=(1,)), y)
+
+        # Removing a node invalidates its outputs and evicts it
+        # from every bound method's cache.
+        graph.nodeRemove(x)
+        self.assertIsNone(x.graph)
+        self.assertIsNone(graph.nodeFromId(x.id))
+        self.assertFalse(y.valid())
+        self.assertEquals(y._inputNodes, ())
+        x2 = o.X.node()
+        self.assertIsNot(x2, x)
+        self.assertIs(graph.nodeResolve(o.X), x2)
+        self.assertEquals(o.Z(), 5)
+        o.X = 2
+        self.assertEquals(o.Z(), 7)
+        self.assertRaises(RuntimeError, graph.nodeRemove, x)
+
+        graph.nodeRemove(y)
+        self.assertIsNot(o.Y.node((1,)), y)
+        self.assertEquals(o.Y(1), 3)
+
+    def test_invalidateOutputs(self):
+        class Diamonds(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def Spot(self, n):
+                return n
+
+            @nodes.graphMethod
+            def Level(self, depth):
+                # Every level reads the level below twice over, so
+                # the number of paths from Spot doubles per level.
+                if depth == 0:
+                    return self.Spot(0) + self.Spot(1)
+                return self.Left(depth) + self.Right(depth)
+
+            @nodes.graphMethod
+            def Left(self, depth):
+                return self.Level(depth - 1)
+
+            @nodes.graphMethod
+            def Right(self, depth):
+                return self.Level(depth - 1)
+
+        graph = nodes.graph._graph
+        d = Diamonds()
+        self.assertEquals(d.Level(30), 2 ** 30)
+
+        invalidated = []
+        subscription = graph.nodeSubscribe(d.Level.node((30,)), lambda *args: invalidated.append(args))
+        spots = [d.Spot.node((0,)), d.Spot.node((1,))]
+        result = graph.nodesInvalidateOutputs(spots)
+        self.assertEquals(len(result), 91)
+        self.assertEquals(len(invalidated), 1)
+        self.assertEquals(graph.nodesInvalidateOutputs(spots), set())
+        graph.nodeUnsubscribe(subscription)
+
+        # A subclass's per-node hook fires once per node per sweep.
+        counts = {}
+        class CountingGraph(nodes.graph.Graph):
+            def onNodeInvalidated(self, node):
+                counts[node] = counts.get(node, 0) + 1
+        self.assertEquals(d.Level(30), 2 ** 30)
+        graph.__class__ = CountingGraph
+        try:
+            result = graph.nodesInvalidateOutputs(spots)
+        finally:
+            graph.__class__ = nodes.graph.Graph
+        self.assertEquals(set(counts), result)
+        self.assertEquals(set(counts.values()), set([1]))
+
+        self.assertEquals(d.Level(30), 2 ** 30)
+        d.Spot.setValue(2, 1)
+        self.assertEquals(d.Level(30), 2 ** 30 * 2)
+
+    def test_batch(self):
+        class Market(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def Spot(self):
+                return 1
+
+            @nodes.graphMethod(nodes.Settable)
+            def Rate(self):
+                return 2
+
+            def setBoth(self, value):
+                return [nodes.NodeChange(self.Spot, value), nodes.NodeChange(self.Rate, value)]
+
+            @nodes.graphMethod(delegate=setBoth)
+            def Both(self):
+                return None
+
+            @nodes.graphMethod
+            def Forward(self):
+                return self.Spot() * self.Rate()
+
+        graph = nodes.graph._graph
+        m = Market()
+        self.assertEquals(m.Forward(), 2)
+        notified = []
+        subscriptions = [graph.nodeSubscribe(n, lambda d, *args: notified.append(d.name))
+                         for n in (m.Spot.node(), m.Rate.node(), m.Forward.node())]
+
+        with graph.batch():
+            m.Spot = 3
+            m.Rate = 4
+            with graph.batch():
+                m.Spot = 5
+            # Changes are not visible until the batch is committed.
+            self.assertEquals(m.Spot(), 1)
+            self.assertEquals(m.Forward(), 2)
+        self.assertEquals(sorted(notified), ['Forward', 'Rate', 'Spot'])
+        self.assertEquals(m.Forward(), 20)
+
+        del notified[:]
+        try:
+            with graph.batch():
+                m.Spot = 7
+                m.Rate.clearValue()
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEquals(notified, [])
+        self.assertEquals(m.Spot(), 5)
+        self.assertEquals(m.Forward(), 20)
+
+        with graph.batch():
+            m.Both = 6
+            m.Rate.clearValue()
+            self.assertRaises(RuntimeError, m.Rate.clearValue)
+        self.assertEquals(sorted(notified), ['Forward', 'Rate', 'Spot'])
+        self.assertEquals(m.Forward(), 12)
+
+        # A failure while applying the batch leaves every value as it was.
+        class Unequal(object):
+            def __eq__(self, other):
+                if other is nodes.CLEAR:
+                    return False
+                raise ValueError()
+        m.Rate = Unequal()
+        try:
+            with graph.batch():
+                m.Spot = 8
+                m.Rate = 9
+        except ValueError:
+            pass
+        self.assertEquals(m.Spot(), 6)
+        self.assertIsInstance(m.Rate(), Unequal)
+
+        for subscription in subscriptions:
+            graph.nodeUnsubscribe(subscription)
+        m.Spot.clearValue()
+        m.Rate.clearValue()
+
+    def test_nestedScenarios(self):
+        computed = []
+
+        class Shock(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def Bump(self, n):
+                return 0
+
+            @nodes.graphMethod
+            def Total(self):
+                computed.append(1)
+                return sum(self.Bump(n) for n in range(20))
+
+            @nodes.graphMethod
+            def Partial(self):
+                return self.Bump(3) * 10
+
+        graph = nodes.graph._graph
+        o = Shock()
+        self.assertEquals(o.Total(), 0)
+
+        # Each level bumps one more input; every level sees all of
+        # the bumps beneath it.
+        scenarios = [nodes.scenario() for _ in range(20)]
+        for n, s in enumerate(scenarios):
+            s.__enter__()
+            o.Bump.setWhatIf(1, n)
+            self.assertEquals(o.Total(), n + 1)
+        self.assertEquals(graph.nodeData(o.Bump.node((0,))).dataStore, scenarios[0])
+        for n, s in reversed(list(enumerate(scenarios))):
+            self.assertEquals(o.Total(), n + 1)
+            self.assertEquals(o.Bump(n), 1)
+            s.__exit__(None, None, None)
+        self.assertEquals(o.Total(), 0)
+        self.assertEquals(graph._state._overlay, {})
+
+        # Data set in a store beneath the active one shows through.
+        with scenarios[0]:
+            with scenarios[1]:
+                self.assertEquals(o.Total(), 2)
+                graph.nodeSetWhatIf(o.Bump.node((5,)), 10, dataStore=scenarios[0])
+                self.assertEquals(o.Bump(5), 10)
+                self.assertEquals(o.Total(), 12)
+                graph.nodeClearWhatIf(o.Bump.node((5,)), dataStore=scenarios[0])
+                self.assertEquals(o.Bump(5), 0)
+                self.assertEquals(o.Total(), 2)
+
+        # Nothing has changed since the scenario was last exited, so
+        # re-entering it reuses what it computed.
+        s = scenarios[3]
+        with s:
+            self.assertEquals(o.Total(), 1)
+        del computed[:]
+        with s:
+            self.assertEquals(o.Total(), 1)
+        self.assertEquals(computed, [])
+        self.assertEquals(o.Partial(), 0)
+        with s:
+            self.assertEquals(o.Partial(), 10)
+            self.assertEquals(o.Total(), 1)
+        self.assertEquals(computed, [])
+        o.Bump.setValue(5, 19)
+        with s:
+            self.assertEquals(o.Total(), 6)
+        self.assertEquals(computed, [1])
+        with scenarios[0]:
+            with s:
+                self.assertEquals(o.Total(), 7)
+        o.Bump.clearValue(19)
+
+        # Copies share what-ifs until one of them changes.
+        c = s.copy()
+        with c:
+            self.assertEquals(o.Bump(3), 1)
+            o.Bump.setWhatIf(2, 3)
+            o.Bump.setWhatIf(2, 4)
+            self.assertEquals(o.Total(), 4)
+        with s:
+            self.assertEquals(o.Bump(3), 1)
+            self.assertEquals(o.Total(), 1)
+            o.Bump.clearWhatIf(3)
+            self.assertEquals(o.Total(), 0)
+        with c:
+            self.assertEquals(o.Total(), 4)
+
+    def test_scenarioValues(self):
+        class Swap(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def Rate(self, tenor):
+                return tenor
+
+            @nodes.graphMethod
+            def Value(self):
+                return sum(self.Rate(t) for t in range(5))
+
+            @nodes.graphMethod
+            def Risk(self):
+                return self.Value() * 2
+
+        s = Swap()
+        outputs = [s.Value.node(), s.Risk.node()]
+        whatIfSets = [[nodes.NodeChange(s.Rate, 10 * n, t) for t in range(n)] for n in range(4)]
+        expected = [[10, 20], [20, 40], [49, 98], [97, 194]]
+        self.assertEquals(nodes.scenarioValues(whatIfSets, outputs, processes=2), expected)
+        self.assertEquals(nodes.scenarioValues(whatIfSets, outputs, processes=1), expected)
+        self.assertEquals(s.Risk(), 20)
+
+    def test_threads(self):
+        calls = []
+
+        class Slow(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def X(self):
+                return 1
+
+            @nodes.graphMethod
+            def Y(self):
+                calls.append(1)
+                time.sleep(0.05)
+                return self.X() * 2
+
+        s = Slow()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(s.Y())) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(results, [2, 2, 2, 2])
+        self.assertEquals(len(calls), 1)
+
+        # A scenario entered in one thread is not seen by another.
+        seen = []
+        entered = threading.Event()
+        done = threading.Event()
+        def inScenario():
+            with nodes.scenario():
+                s.X.setWhatIf(5)
+                seen.append(s.Y())
+                entered.set()
+                done.wait()
+        t = threading.Thread(target=inScenario)
+        t.start()
+        entered.wait()
+        self.assertEquals(s.Y(), 2)
+        s.X = 3                 # Reaches the other thread's scenario too.
+        done.set()
+        t.join()
+        self.assertEquals(seen, [10])
+        self.assertEquals(s.Y(), 6)
+
+    def test_threadsReadWhileSetting(self):
+        class Book(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def X(self):
+                return 1
+
+            @nodes.graphMethod
+            def Leaf(self, i):
+                return self.X() + i
+
+        b = Book()
+        stop = threading.Event()
+        bad = []
+        def read(inScenario):
+            def readAll():
+                while not stop.is_set():
+                    for i in range(20):
+                        if b.Leaf(i) is None:
+                            bad.append(i)
+            try:
+                if inScenario:
+                    with nodes.scenario():
+                        readAll()
+                else:
+                    readAll()
+            except Exception as e:
+                bad.append(e)
+        threads = [threading.Thread(target=read, args=(i % 2,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        try:
+            for x in xrange(2000):
+                b.X = x
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
+        self.assertEquals(bad, [])
+        self.assertEquals([b.Leaf(i) for i in range(20)], [1999 + i for i in range(20)])
+
+        # A value computed while a sweep is under way is returned but
+        # not kept, since it may have read inputs not yet swept.
+        graph = nodes.graph._graph
+        values = []
+        def sweepOutputs(nodes, dataStore, invalidate=True):
+            swept = sweep(nodes, dataStore, invalidate=invalidate)
+            t = threading.Thread(target=lambda: values.append(b.Leaf(100)))
+            t.start()
+            t.join()
+            return swept
+        sweep = graph._nodesSweepOutputs
+        graph._nodesSweepOutputs = sweepOutputs
+        try:
+            b.X = 0
+        finally:
+            del graph._nodesSweepOutputs
+        self.assertEquals(values, [100])
+        self.assertFalse(b.Leaf.node((100,)).valid())
+        self.assertEquals(b.Leaf(100), 100)
+        self.assertTrue(b.Leaf.node((100,)).valid())
+
+    def test_nodeValues(self):
+        class Pricer(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def Spot(self, name):
+                return 100
+
+            @nodes.graphMethod
+            def Quote(self, name):
+                time.sleep(0.1)     # Stands in for a remote call.
+                return self.Spot(name) + 1
+
+            @nodes.graphMethod
+            def Total(self):
+                return sum(nodes.values([self.Quote.node((name,)) for name in 'abcd']))
+
+            @nodes.graphMethod
+            def Half(self):
+                return self.Quote.node(('a',)).value() / 2
+
+        p = Pricer()
+        start = time.time()
+        self.assertEquals(p.Total(), 404)
+        self.assertTrue(time.time() - start < 0.3)
+        self.assertEquals(len(p.Total.node()._inputNodes), 4)
+
+        # A fetch and a plain read of the same node share a computation.
+        p.Spot.setValue(200, 'a')
+        fetch = nodes.graph._graph.nodeValueAsync(p.Quote.node(('a',)))
+        self.assertEquals(p.Half(), 100)
+        self.assertEquals(fetch.get(), 201)
+        self.assertEquals(p.Total(), 504)
+
+        # Fetches run in the scenario they were started in.
+        with nodes.scenario():
+            p.Spot.setWhatIf(50, 'b')
+            self.assertEquals(p.Total(), 454)
+        self.assertEquals(p.Total(), 504)
+
+        # Nor do they see scenarios the caller enters while they run.
+        started = threading.Event()
+        go = threading.Event()
+
+        class Slow(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def X(self):
+                return 1
+
+            @nodes.graphMethod
+            def Y(self):
+                started.set()
+                go.wait()
+                return self.X() * 100
+
+        s = Slow()
+        with nodes.scenario() as scenario:
+            s.X.setWhatIf(7)
+        fetch = nodes.graph._graph.nodeValueAsync(s.Y.node())
+        started.wait()
+        with scenario:
+            go.set()
+            self.assertEquals(fetch.get(), 100)
+        self.assertEquals(s.Y(), 100)
+        with scenario:
+            self.assertEquals(s.Y(), 700)
+
+        class Failing(nodes.GraphObject):
+
+            @nodes.graphMethod
+            def X(self):
+                raise ValueError()
+
+        self.assertRaises(ValueError, nodes.graph._graph.nodeValueAsync(Failing().X.node()).get)
+
+    def test_valueCache(self):
+        calls = []
+
+        class Book(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def Notional(self):
+                return 100
+
+            @nodes.graphMethod
+            def Cashflow(self, i):
+                calls.append(i)
+                return self.Notional() * i
+
+            @nodes.graphMethod
+            def Total(self):
+                return sum(self.Cashflow(i) for i in range(10))
+
+        graph = nodes.graph._graph
+        cache = graph.nodeCache = nodes.NodeCache(maxEntries=4)
+        try:
+            b = Book()
+            self.assertEquals(b.Total(), 4500)
+            self.assertEquals(cache.entries, 4)
+            self.assertEquals(cache.evictions, cache.misses - cache.entries)
+            hits = cache.hits
+            self.assertEquals(b.Total(), 4500)
+            self.assertEquals(cache.hits, hits + 1)
+
+            # An evicted value is recomputed on demand.
+            del calls[:]
+            self.assertEquals(b.Cashflow(0), 0)
+            self.assertEquals(calls, [0])
+
+            # Edges survive eviction, so a change still reaches Total.
+            b.Notional = 1
+            self.assertEquals(b.Total(), 45)
+
+            byteCache = graph.nodeCache = nodes.NodeCache(maxBytes=100, sizeof=lambda value: 40)
+            b.Notional = 2
+            self.assertEquals(b.Total(), 90)
+            self.assertTrue(byteCache.bytes <= 100)
+            self.assertEquals(byteCache.entries, 2)
+        finally:
+            graph.nodeCache = None
+
+    def test_costAwareCache(self):
+        calls = []
+
+        class Deal(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def Name(self):
+                return 'swap'
+
+            @nodes.graphMethod
+            def Label(self):
+                calls.append('Label')
+                return self.Name().upper()
+
+            @nodes.graphMethod
+            def Price(self):
+                calls.append('Price')
+                time.sleep(0.01)
+                return len(self.Name())
+
+            @nodes.graphMethod(cache=True)
+            def Id(self):
+                calls.append('Id')
+                return id(self)
+
+            @nodes.graphMethod(cache=False)
+            def Risk(self):
+                calls.append('Risk')
+                time.sleep(0.01)
+                return self.Price() * 2
+
+        graph = nodes.graph._graph
+        cache = graph.nodeCache = nodes.CostAwareNodeCache(minCost=0.005, minReuse=2, maxEntries=1)
+        try:
+            d = Deal()
+            filler = Deal()
+            for method in (d.Label, d.Price, d.Id, d.Risk, filler.Label):
+                method()
+            del calls[:]
+            for method in (d.Label, d.Price, d.Id, d.Risk):
+                method()
+            # Label and Risk are cheap or forced cheap, and were evicted.
+            self.assertEquals(calls, ['Label', 'Risk'])
+
+            # A cheap value computed often enough is kept.
+            for i in range(3):
+                filler.Label()
+                d.Label()
+            del calls[:]
+            filler.Label()
+            d.Label()
+            self.assertEquals(calls, [])
+            self.assertTrue(cache.kept >= 3)
+
+            # Kept values are still invalidated.
+            d.Name = 'bond'
+            self.assertEquals(d.Label(), 'BOND')
+            self.assertEquals(d.Risk(), 8)
+        finally:
+            graph.nodeCache = None
+
+    def test_profiler(self):
+        class Trade(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def Spot(self):
+                return 10
+
+            @nodes.graphMethod
+            def Price(self):
+                time.sleep(0.01)
+                return self.Spot() * 2
+
+            @nodes.graphMethod
+            def Value(self):
+                return self.Price() + self.Price()
+
+        t = Trade()
+        with nodes.GraphProfiler() as profiler:
+            t.Value()
+            t.Value()
+            t.Spot = 11
+            t.Value()
+        self.assertEquals(nodes.graph._graph.profiler, None)
+
+        profiles = profiler.methodProfiles()
+        price, value = profiles['Trade.Price'], profiles['Trade.Value']
+        self.assertEquals((price.computes, price.hits, price.invalidations), (2, 2, 1))
+        self.assertEquals((value.computes, value.hits, value.invalidations), (2, 1, 1))
+        self.assertTrue(price.exclusive >= 0.02)
+        self.assertTrue(value.inclusive >= price.inclusive > value.exclusive)
+        self.assertEquals(profiler.nodeProfiles()[t.Price.node()].computes, 2)
+
+        folded = profiler.folded()
+        self.assertTrue(any(line.startswith('Trade.Value;Trade.Price ') for line in folded))
+        stats = profiler.stats()
+        self.assertEquals(stats.total_calls, 5)      # Spot once, Price and Value twice.
+        self.assertTrue('Trade.Price' in profiler.report())
+
+    def test_introspect(self):
+        introspect = nodes.introspect
+
+        class Env(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def Date(self):
+                return 1
+
+        class Leg(nodes.GraphObject):
+
+            @nodes.graphMethod
+            def Cashflow(self, i):
+                return env.Date() + i
+
+            @nodes.graphMethod
+            def Value(self):
+                return sum(self.Cashflow(i) for i in range(3))
+
+        env = Env()
+        legs = [Leg() for i in range(4)]
+        count = introspect.nodeCount()
+        edges = introspect.edgeCount()
+        for leg in legs:
+            leg.Value()
+        self.assertEquals(introspect.nodeCount(), count + 1 + 4 * 4)
+        self.assertEquals(introspect.edgeCount(), edges + 4 * 3 * 2)
+        self.assertEquals(introspect.methodCounts()['Leg.Cashflow'], 12)
+        self.assertEquals(introspect.fanInHistogram()['Leg.Value'], {3: 4})
+        self.assertEquals(introspect.fanOutHistogram()['Env.Date'], {12: 1})
+        self.assertTrue(env.Date.node() in introspect.hubs(limit=1))
+
+        date, value = env.Date.node(), legs[0].Value.node()
+        self.assertEquals(len(introspect.downstream(date)), 16)
+        self.assertEquals(introspect.upstream(value), set([date] + [legs[0].Cashflow.node((i,)) for i in range(3)]))
+
+        f = StringIO.StringIO()
+        introspect.writeDot(f, nodes=introspect.upstream(value) | set([value]))
+        dot = f.getvalue()
+        self.assertTrue(dot.startswith('digraph'))
+        self.assertEquals(dot.count(' -> '), 6)
+        self.assertTrue('Env.Date()' in dot)
+
+        inputs, outputs = introspect.edgeArrays()
+        self.assertEquals(len(inputs), introspect.edgeCount())
+        self.assertEquals(inputs.itemsize + outputs.itemsize, 8)
+        self.assertTrue((date.id, legs[0].Cashflow.node((0,)).id) in zip(inputs, outputs))
+        f = StringIO.StringIO()
+        introspect.writeEdgeList(f)
+        self.assertEquals(f.getvalue().count('\n'), len(inputs))
+
+    def test_pruneEdges(self):
+        calls = []
+
+        class Instrument(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def Expired(self):
+                return False
+
+            @nodes.graphMethod(nodes.Settable)
+            def Coupon(self):
+                return 5
+
+            @nodes.graphMethod(nodes.Settable)
+            def Redemption(self):
+                return 100
+
+            @nodes.graphMethod
+            def NextEvent(self):
+                calls.append(1)
+                return self.Redemption() if self.Expired() else self.Coupon()
+
+        i = Instrument()
+        self.assertEquals(i.NextEvent(), 5)
+        i.Expired = True
+        self.assertEquals(i.NextEvent(), 100)
+        self.assertFalse(i.Coupon.node() in i.NextEvent.node()._inputNodes)
+        self.assertFalse(i.NextEvent.node() in i.Coupon.node()._outputNodes)
+
+        # The stale edge no longer invalidates.
+        del calls[:]
+        i.Coupon = 6
+        self.assertEquals(i.NextEvent(), 100)
+        self.assertEquals(calls, [])
+
+        # Edges used by an active scenario are kept.
+        with nodes.scenario():
+            i.Expired.setWhatIf(False)
+            self.assertEquals(i.NextEvent(), 6)
+            i.Expired = False
+            self.assertEquals(i.NextEvent(), 6)
+            self.assertTrue(i.Redemption.node() in i.NextEvent.node()._inputNodes)
+        i.Redemption = 50
+        self.assertEquals(i.NextEvent(), 6)
+
+    def test_earlyCutoff(self):
+        calls = []
+
+        class Env(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def AsOf(self):
+                return 10.25
+
+            @nodes.graphMethod
+            def Cutoff(self):
+                calls.append('Cutoff')
+                return int(self.AsOf())
+
+            @nodes.graphMethod
+            def Report(self):
+                calls.append('Report')
+                return self.Cutoff() * 2
+
+            @nodes.graphMethod(equals=lambda a, b: a[0] == b[0])
+            def Curve(self):
+                calls.append('Curve')
+                return [self.Cutoff(), self.AsOf()]
+
+            @nodes.graphMethod
+            def Discount(self):
+                calls.append('Discount')
+                return self.Curve()[0]
+
+        graph = nodes.graph._graph
+        graph.earlyCutoff = True
+        try:
+            e = Env()
+            self.assertEquals((e.Report(), e.Discount()), (20, 10))
+            del calls[:]
+            e.AsOf = 10.75
+            self.assertEquals((e.Report(), e.Discount()), (20, 10))
+            self.assertEquals(calls, ['Cutoff', 'Curve'])
+            self.assertEquals(e.Curve(), [10, 10.75])
+
+            del calls[:]
+            e.AsOf = 11.5
+            self.assertEquals(e.Report(), 22)
+            self.assertEquals(e.Discount(), 11)
+            self.assertEquals(sorted(calls), ['Curve', 'Cutoff', 'Discount', 'Report'])
+
+            # Without early cutoff, everything downstream is recomputed.
+            graph.earlyCutoff = False
+            del calls[:]
+            e.AsOf = 11.25
+            self.assertEquals((e.Report(), e.Discount()), (22, 11))
+            self.assertEquals(sorted(calls), ['Curve', 'Cutoff', 'Discount', 'Report'])
+        finally:
+            graph.earlyCutoff = False
+
+    def test_pushSubscriptions(self):
+        calls = []
+
+        class Position(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def Price(self):
+                return 10
+
+            @nodes.graphMethod(nodes.Settable)
+            def Quantity(self):
+                return 2
+
+            @nodes.graphMethod
+            def Value(self):
+                calls.append('Value')
+                return self.Price() * self.Quantity()
+
+            @nodes.graphMethod
+            def PnL(self):
+                calls.append('PnL')
+                return self.Value() - 20
+
+            @nodes.graphMethod
+            def Report(self):
+                calls.append('Report')
+                return (self.Value(), self.PnL())
+
+        p = Position()
+        delivered = []
+        callback = lambda descriptor, value, *args: delivered.append((descriptor.name, value))
+        subscriptions = [p.Report.subscribe(callback, push=True), p.PnL.subscribe(callback, push=True)]
+        p.Report()
+
+        del calls[:]
+        p.Price = 11
+        self.assertEquals(delivered, [('PnL', 2), ('Report', (22, 2))])
+        self.assertEquals(sorted(calls), ['PnL', 'Report', 'Value'])
+
+        del delivered[:]
+        with nodes.batch():
+            p.Price = 12
+            p.Quantity = 3
+        self.assertEquals(delivered, [('PnL', 16), ('Report', (36, 16))])
+
+        for subscription in subscriptions:
+            p.Report.unsubscribe(subscription)
+        del delivered[:]
+        p.Price = 13
+        self.assertEquals(delivered, [])
+
+    def test_subscriptionIndex(self):
+        class Fan(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def Input(self):
+                return 1
+
+            @nodes.graphMethod
+            def Output(self, i):
+                return self.Input() + i
+
+        graph = nodes.graph._graph
+        f = Fan()
+        for i in range(100):
+            f.Output(i)
+        count = len(graph._subscriptions)
+        f.Input = 2
+        self.assertEquals(len(graph._subscriptions), count)
+
+        notified = []
+        node = f.Output.node((3,))
+        subscriptions = [graph.nodeSubscribe(node, lambda *args: notified.append(args)) for i in range(2)]
+        self.assertTrue(graph._subscriptions.subscribed(node.id))
+        f.Output(3)
+        f.Input = 3
+        self.assertEquals(len(notified), 2)
+        graph.nodeUnsubscribe(subscriptions[0])
+        self.assertTrue(graph._subscriptions.subscribed(node.id))
+        graph.nodeUnsubscribeAll(node.id)
+        self.assertFalse(graph._subscriptions.subscribed(node.id))
+        self.assertEquals(len(graph._subscriptions), count)
+        f.Output(3)
+        f.Input = 4
+        self.assertEquals(len(notified), 2)
+
+    def test_release(self):
+        class Quote(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def Price(self):
+                return 10
+
+            @nodes.graphMethod
+            def Value(self, quantity):
+                return self.Price() * quantity
+
+        class Book(nodes.GraphObject):
+
+            @nodes.graphMethod
+            def Total(self, quote):
+                return quote.Value(2) + 1
+
+        graph = nodes.graph._graph
+        gc.collect()
+        graph._objsReleaseCollected()
+        count = len(graph._nodesById)
+        b = Book()
+        q = Quote()
+        self.assertEquals(b.Total(q), 21)
+        nodeIds = [q.Price.node().id, q.Value.node((2,)).id]
+        total = b.Total.node((q,))
+        subscription = q.Price.subscribe(lambda *args: None)
+        self.assertEquals(len(graph._nodesById), count + 3)
+
+        graph.release(q)
+        self.assertEquals(len(graph._nodesById), count + 1)
+        for nodeId in nodeIds:
+            self.assertEquals(graph.nodeFromId(nodeId), None)
+            self.assertEquals(graph.rootDataStore._nodeDataByNodeId.get(nodeId), None)
+            self.assertFalse(graph._subscriptions.subscribed(nodeId))
+        nodeData = graph.rootDataStore._nodeDataByNodeId.get(total.id)
+        self.assertFalse(nodeData and nodeData._flags & nodes.graph.NodeData.VALID)
+        self.assertEquals(total._inputNodes, ())
+        self.assertEquals(b.Total(q), 21)
+
+        q.Price = 5
+        self.assertEquals(b.Total(q), 11)
+        graph.release(b)
+        self.assertEquals(len(graph._nodesById), count + 2)
+        nodeIds = [q.Price.node().id, q.Value.node((2,)).id]
+        del b, q, total, nodeData, subscription
+        gc.collect()
+        Quote().Price()
+        for nodeId in nodeIds:
+            self.assertEquals(graph.nodeFromId(nodeId), None)
+            self.assertEquals(graph.rootDataStore._nodeDataByNodeId.get(nodeId), None)
+
+    def test_collect(self):
+        class Instrument(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def Spot(self):
+                return 100
+
+            @nodes.graphMethod
+            def EventPosition(self, event):
+                return self.Spot() * event
+
+            @nodes.graphMethod
+            def Position(self):
+                return sum(self.EventPosition(event) for event in range(20))
+
+        graph = nodes.graph._graph
+        gc.collect()
+        graph.collect()
+        count = len(graph._nodesById)
+        i = Instrument()
+        self.assertEquals(i.Position(), 19000)
+        spot = i.Spot.node()
+        position = i.Position.node()
+        self.assertEquals(type(spot._outputNodes), set)
+        i.Spot = 50
+        subscription = graph.nodeSubscribe(i.EventPosition.node((3,)), lambda *args: None)
+        scenario = nodes.scenario()
+        with scenario:
+            i.EventPosition(4)
+
+        reclaimed = graph.collect()
+        self.assertEquals(reclaimed['nodes'], 19)
+        self.assertEquals(reclaimed['edges'], 18 + 20)
+        self.assertTrue(reclaimed['nodeData'] >= 19)
+        self.assertEquals(len(graph._nodesById), count + 3)
+        self.assertTrue(position._graph is None)
+        self.assertTrue(spot._graph is graph)
+        self.assertEquals(type(spot._outputNodes), tuple)
+        self.assertEquals(len(spot._outputNodes), 2)
+        self.assertEquals(i.Position(), 9500)
+        self.assertEquals(graph.collect()['nodes'], 0)
+
+        graph.nodeUnsubscribe(subscription)
+        i.Spot.clearValue()
+        del scenario
+        gc.collect()
+        graph.collect()
+        self.assertEquals(len(graph._nodesById), count)
+
+    def test_scenarioDiff(self):
+        computed = []
+
+        class Book(nodes.GraphObject):
+
+            @nodes.graphMethod(nodes.Settable)
+            def Rate(self):
+                return 1
+
+            @nodes.graphMethod(nodes.Settable)
+            def Spot(self):
+                return 100
+
+            @nodes.graphMethod
+            def Risk(self, i):
+                computed.append(i)
+                return self.Spot() * i if i % 2 else self.Rate() * i
+
+        b = Book()
+        risks = [b.Risk.node((i,)) for i in range(6)]
+        with nodes.scenario() as base:
+            b.Rate.setWhatIf(2)
+        with nodes.scenario() as bumped:
+            b.Rate.setWhatIf(2)
+            b.Spot.setWhatIf(101)
+        self.assertEquals(len(bumped.whatIfs()), 2)
+        self.assertTrue(bumped.whatIfs() is bumped.whatIfs())
+        with bumped:
+            with nodes.scenario() as nested:
+                b.Spot.setWhatIf(102)
+                self.assertEquals(sorted(whatIf.value for whatIf in nested.activeWhatIfs()), [2, 102])
+
+        diff = bumped.diff(risks, base)
+        self.assertEquals(sorted(computed), [0, 1, 1, 2, 3, 3, 4, 5, 5])
+        self.assertEquals(diff.whatIfs, [(b.Spot.node(), 101)])
+        self.assertEquals(diff.changed, {risks[1]: (100, 101), risks[3]: (300, 303), risks[5]: (500, 505)})
+        del computed[:]
+        self.assertEquals(len(bumped.diff(risks, base)), 3)
+        self.assertEquals(computed, [])
+
+        diff = base.diff(risks)
+        self.assertEquals(diff.whatIfs, [(b.Rate.node(), 2)])
+        self.assertEquals(sorted(node.args[0] for node in diff.changed), [2, 4])
+        self.assertEquals(len(nodes.scenario().diff(risks)), 0)
+
+        replayed = bumped.diff(risks, base).replay(base.copy())
+        with replayed:
+            self.assertEquals(b.Risk(3), 303)
+            self.assertEquals(b.Risk(2), 4)
+        diff = base.diff(risks, bumped)
+        self.assertEquals(diff.whatIfs, [(b.Spot.node(), nodes.graph.CLEAR)])
+        self.assertEquals(diff.changed[risks[1]], (101, 100))
+        with diff.replay(bumped.copy()):
+            self.assertEquals(b.Risk(1), 100)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,4 @@
+from store import ObjectStore, className
+from codec import ObjectCodec
+import codec
+import checkpoint
@@ -0,0 +1,216 @@
+"""Checkpoints a graph to a file, and restores it in a new process.
+
+A checkpoint holds the graph's node table, the dependency edges
+between its nodes and the valid values of the root data store.  A
+process restoring it rebuilds the nodes and edges, but leaves the
+values in a memory-mapped view of the file, each decoded only when
+the graph first reads it (see Graph.page), so the process can serve
+straight away, and only pages in what it reads.
+
+Nodes are keyed by the graph objects they belong to, which a
+checkpoint identifies by their ids in an ObjectStore, and restore
+loads from it lazily.  Nodes of objects the store does not know, or
+with arguments that cannot be pickled, are left out together with
+everything computed from them; the edges restored are then complete,
+so a change made after restoring invalidates every restored value
+that depends on it.
+
+"""
+import array
+import cPickle
+import cStringIO
+import mmap
+import struct
+
+import nodes
+from nodes.graph import NodeData, _graph
+
+import codec
+
+
+_MAGIC = 'NODESCK1'
+_header = struct.Struct('<8sQQQ')   # Magic, then offsets of the node table, edges and value index.
+
+
+class _Unknown(Exception):
+    """Raised when pickling an object the store does not know."""
+
+
+def checkpoint(path, store, graph=None):
+    """Writes a checkpoint of the graph to the file at path, and
+    returns the numbers of nodes, edges and values written.
+
+    """
+    graph = graph or _graph
+    objIds = set()
+
+    def persistentId(obj):
+        if isinstance(obj, nodes.GraphObject):
+            objId = store.objId(obj)
+            if objId is None:
+                raise _Unknown()
+            objIds.add(objId)
+            return str(objId)
+        return None
+
+    table = []
+    index = {}
+    skipped = []
+    for node in graph._nodesById.values():
+        obj = node.obj
+        objId = store.objId(obj) if isinstance(obj, nodes.GraphObject) else None
+        args = None
+        if objId is not None and node._args:
+            stream = cStringIO.StringIO()
+            pickler = cPickle.Pickler(stream, cPickle.HIGHEST_PROTOCOL)
+            pickler.persistent_id = persistentId
+            try:
+                pickler.dump(node._args)
+                args = stream.getvalue()
+            except (_Unknown, cPickle.PicklingError, TypeError):
+                objId = None
+        if objId is None:
+            skipped.append(node)
+            continue
+        objIds.add(objId)
+        index[node] = len(table)
+        table.append((objId, node.name, args))
+    for node in _downstream(skipped):
+        if node in index:
+            table[index.pop(node)] = None
+
+    inputs = array.array('l')
+    outputs = array.array('l')
+    for node, i in index.iteritems():
+        for output in node._outputNodes:
+            j = index.get(output)
+            if j is not None:
+                inputs.append(i)
+                outputs.append(j)
+
+    rootDataStore = graph.rootDataStore
+    valueNodes = array.array('l')
+    valueFlags = array.array('B')
+    valueOffsets = array.array('l')
+    with open(path, 'wb') as f:
+        f.write('\0' * _header.size)
+        tableOffset = _write(f, codec.dumps([sorted(objIds), cPickle.dumps(table, cPickle.HIGHEST_PROTOCOL)]))
+        edgesOffset = _write(f, codec.dumps([inputs, outputs]))
+        for node, i in index.iteritems():
+            nodeData = rootDataStore._nodeDataByNodeId.get(node._id)
+            if nodeData is None or nodeData._dataStore is not rootDataStore or not nodeData._flags & NodeData.VALID:
+                continue
+            try:
+                data = codec.dumps(nodeData._value)
+            except (cPickle.PicklingError, TypeError):
+                continue
+            valueNodes.append(i)
+            valueFlags.append(nodeData._flags & NodeData.FIXED)
+            valueOffsets.append(_write(f, data))
+        indexOffset = _write(f, codec.dumps([valueNodes, valueFlags, valueOffsets]))
+        f.seek(0)
+        f.write(_header.pack(_MAGIC, tableOffset, edgesOffset, indexOffset))
+    return {'nodes': len(index), 'edges': len(inputs), 'values': len(valueNodes)}
+
+def _write(f, data):
+    offset = f.tell()
+    padding = -offset % 8
+    f.write('\0' * padding)
+    f.write(data)
+    return offset + padding
+
+def _downstream(roots):
+    closure = set(roots)
+    work = list(roots)
+    while work:
+        for output in work.pop()._outputNodes:
+            if output not in closure:
+                closure.add(output)
+                work.append(output)
+    return closure
+
+
+def restore(path, store, graph=None):
+    """Restores the checkpoint in the file at path into the graph,
+    and returns the numbers of nodes, edges and values restored.
+
+    The graph's own values are kept; the restored values of nodes
+    without one are paged in from the file as they are read, so the
+    file must not be changed while the graph uses it.
+
+    """
+    graph = graph or _graph
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, tableOffset, edgesOffset, indexOffset = _header.unpack_from(data, 0)
+    if magic != _MAGIC:
+        raise RuntimeError("%s is not a graph checkpoint." % path)
+
+    objIds, table = codec.loadsFrom(data, tableOffset)[0]
+    objs = store.loadIds(objIds, lazy=True)
+
+    def persistentLoad(objId):
+        return objs[int(objId)]
+
+    restored = []
+    for record in cPickle.loads(table):
+        node = None
+        if record is not None:
+            objId, name, args = record
+            method = getattr(objs.get(objId), name, None)
+            if args is not None:
+                unpickler = cPickle.Unpickler(cStringIO.StringIO(args))
+                unpickler.persistent_load = persistentLoad
+                try:
+                    args = unpickler.load()
+                except KeyError:
+                    method = None
+            if isinstance(method, nodes.graph.NodeDescriptorBound):
+                node = method.node(args or ())
+        restored.append(node)
+
+    inputs, outputs = codec.loadsFrom(data, edgesOffset)[0]
+    if None in restored:
+        outputsByIndex = {}
+        for i, j in zip(inputs, outputs):
+            outputsByIndex.setdefault(i, []).append(j)
+        work = [i for i, node in enumerate(restored) if node is None]
+        while work:
+            for j in outputsByIndex.get(work.pop(), ()):
+                if restored[j] is not None:
+                    restored[j] = None
+                    work.append(j)
+    edges = 0
+    with graph._lock:
+        for i, j in zip(inputs, outputs):
+            if restored[i] is not None and restored[j] is not None:
+                graph._nodeAddDependency(restored[j], restored[i])
+                edges += 1
+
+    valueNodes, valueFlags, valueOffsets = codec.loadsFrom(data, indexOffset)[0]
+    pager = _Pager(data)
+    pages = []
+    for i, flags, offset in zip(valueNodes, valueFlags, valueOffsets):
+        node = restored[i]
+        if node is not None:
+            pager._offsets[node._id] = offset
+            pages.append((node, bool(flags & NodeData.FIXED)))
+    graph.page(pages, pager)
+    return {'nodes': len(restored) - restored.count(None), 'edges': edges, 'values': len(pages)}
+
+
+class _Pager(object):
+    """Decodes restored values from the checkpoint file.
+
+    Values are copied out of the file rather than decoded zero-copy,
+    so a restored node returns the same types, arrays included, as
+    the graph it was checkpointed from.
+
+    """
+
+    def __init__(self, data):
+        self._data = data
+        self._offsets = {}      # Node id -> offset of its value.
+
+    def page(self, node):
+        return codec.loadsFrom(self._data, self._offsets.pop(node._id))[0]
@@ -0,0 +1,456 @@
+"""Encodes node values and graph object state in a compact binary
+format.
+
+Every value is a one byte tag followed by its payload, little endian
+throughout.  Besides the basic types the format has its own encodings
+for Decimal, datetime and date, and for lists holding only floats or
+only ints, which are packed as one array rather than element by
+element.  Anything else is pickled.
+
+A numeric array.array is written as its raw machine data, 8-byte
+aligned from the start of the encoding, so decoding with zeroCopy set returns an ArrayView onto the
+encoded bytes instead of a copy; decoding from an mmap then only
+pages in the parts of the payload actually read.
+
+ObjectCodec encodes the values set on a graph object's stored
+methods, using the class's stored methods as its schema, and
+dumpDataStore and loadDataStore snapshot the NodeData of a data
+store, and dumpScenarioDiff and loadScenarioDiff persist the
+difference between two scenarios.
+
+"""
+import array
+import cPickle
+import datetime
+import decimal
+import struct
+
+from nodes.graph import CLEAR, NodeData, ScenarioDiff, _graph
+
+
+_int = struct.Struct('<q')
+_float = struct.Struct('<d')
+_length = struct.Struct('<I')
+_datetime = struct.Struct('<HBBBBBI')
+_date = struct.Struct('<HBB')
+_arrayHeader = struct.Struct('<cIB')
+_nodeData = struct.Struct('<qB')
+
+_INT_MIN = -2 ** 63
+_INT_MAX = 2 ** 63 - 1
+
+
+class ArrayView(object):
+    """A read-only view of an encoded numeric array, reading its
+    elements in place from the encoded bytes.
+
+    """
+    __slots__ = ('_typecode', '_data', '_offset', '_count', '_itemsize')
+
+    def __init__(self, typecode, data, offset, count):
+        self._typecode = typecode
+        self._data = data
+        self._offset = offset
+        self._count = count
+        self._itemsize = array.array(typecode).itemsize
+
+    @property
+    def typecode(self):
+        return self._typecode
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError('array index out of range')
+        return struct.unpack_from(self._typecode, self._data, self._offset + i * self._itemsize)[0]
+
+    def __iter__(self):
+        return iter(self.array())
+
+    def buffer(self):
+        """Returns the elements' bytes as a buffer, without copying."""
+        return buffer(self._data, self._offset, self._count * self._itemsize)
+
+    def array(self):
+        """Returns a copy of the elements as an array.array."""
+        result = array.array(self._typecode)
+        result.fromstring(self.buffer())
+        return result
+
+    def tolist(self):
+        return self.array().tolist()
+
+
+_tagged = dict((tag, struct.Struct('<c' + code)) for tag, code in
+               [('i', 'q'), ('f', 'd'), ('s', 'I'), ('M', 'HBBBBBI'), ('d', 'HBB')])
+_packInt = _tagged['i'].pack
+_packFloat = _tagged['f'].pack
+_packLength = _tagged['s'].pack
+_packDatetime = _tagged['M'].pack
+_packDate = _tagged['d'].pack
+
+
+class _Chunks(list):
+    """The chunks of an encoding so far, keeping a running count of
+    their bytes so that an array can be aligned without measuring
+    every chunk before it again.
+
+    """
+    __slots__ = ('_measured', '_bytes')
+
+    def __init__(self, chunks=()):
+        list.__init__(self, chunks)
+        self._measured = 0
+        self._bytes = 0
+
+    def offset(self):
+        """Returns the number of bytes encoded so far."""
+        if self._measured < len(self):
+            self._bytes += sum(map(len, self[self._measured:]))
+            self._measured = len(self)
+        return self._bytes
+
+
+def _encode(value, chunks):
+    encode = _encoders.get(type(value))
+    if encode is None:
+        _encodePickled(value, chunks)
+    else:
+        encode(value, chunks)
+
+def _encodePickled(value, chunks):
+    value = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+    chunks.append(_packLength('P', len(value)))
+    chunks.append(value)
+
+def _encodeInt(value, chunks):
+    if _INT_MIN <= value <= _INT_MAX:
+        chunks.append(_packInt('i', value))
+    else:
+        value = str(value)
+        chunks.append(_packLength('I', len(value)))
+        chunks.append(value)
+
+def _encodeStr(value, chunks, tag='s'):
+    chunks.append(_packLength(tag, len(value)))
+    chunks.append(value)
+
+def _encodeDatetime(value, chunks):
+    if value.tzinfo is not None:
+        _encodePickled(value, chunks)
+    else:
+        chunks.append(_packDatetime('M', value.year, value.month, value.day, value.hour,
+                                    value.minute, value.second, value.microsecond))
+
+def _encodeList(value, chunks, tag='l'):
+    count = len(value)
+    if count > 1 and tag == 'l':
+        types = set(map(type, value))
+        if len(types) == 1:
+            if float in types:
+                chunks.append(_packLength('g', count))
+                chunks.append(struct.pack('<%dd' % count, *value))
+                return
+            if int in types:
+                chunks.append(_packLength('h', count))
+                chunks.append(struct.pack('<%dq' % count, *value))
+                return
+    chunks.append(_packLength(tag, count))
+    encoders = _encoders
+    for item in value:
+        encode = encoders.get(type(item))
+        if encode is None:
+            _encodePickled(item, chunks)
+        else:
+            encode(item, chunks)
+
+def _encodeDict(value, chunks):
+    chunks.append(_packLength('m', len(value)))
+    for key, item in value.iteritems():
+        _encode(key, chunks)
+        _encode(item, chunks)
+
+def _encodeArray(value, chunks):
+    if value.typecode in ('c', 'u'):
+        _encodePickled(value, chunks)
+        return
+    padding = -(chunks.offset() + 1 + _arrayHeader.size) % 8
+    chunks.append('A')
+    chunks.append(_arrayHeader.pack(value.typecode, len(value), padding))
+    chunks.append('\0' * padding)
+    chunks.append(value.tostring())
+
+_encoders = {
+    type(None): lambda value, chunks: chunks.append('N'),
+    bool: lambda value, chunks: chunks.append('T' if value else 'F'),
+    int: _encodeInt,
+    long: _encodeInt,
+    float: lambda value, chunks: chunks.append(_packFloat('f', value)),
+    str: _encodeStr,
+    unicode: lambda value, chunks: _encodeStr(value.encode('utf-8'), chunks, 'u'),
+    decimal.Decimal: lambda value, chunks: _encodeStr(str(value), chunks, 'D'),
+    datetime.datetime: _encodeDatetime,
+    datetime.date: lambda value, chunks: chunks.append(_packDate('d', value.year, value.month, value.day)),
+    list: _encodeList,
+    tuple: lambda value, chunks: _encodeList(value, chunks, 't'),
+    dict: _encodeDict,
+    array.array: _encodeArray,
+}
+
+
+def _decodeBytes(data, pos):
+    length, = _length.unpack_from(data, pos)
+    pos += _length.size
+    return data[pos:pos + length], pos + length
+
+def _decodeItems(data, pos, zeroCopy):
+    count, = _length.unpack_from(data, pos)
+    pos += _length.size
+    items = []
+    for _ in xrange(count):
+        item, pos = _decode(data, pos, zeroCopy)
+        items.append(item)
+    return items, pos
+
+def _decodePacked(code, size):
+    def decode(data, pos, zeroCopy):
+        count, = _length.unpack_from(data, pos)
+        pos += _length.size
+        return list(struct.unpack_from('<%d%s' % (count, code), data, pos)), pos + count * size
+    return decode
+
+def _decodeTuple(data, pos, zeroCopy):
+    items, pos = _decodeItems(data, pos, zeroCopy)
+    return tuple(items), pos
+
+def _decodeDict(data, pos, zeroCopy):
+    count, = _length.unpack_from(data, pos)
+    pos += _length.size
+    items = {}
+    for _ in xrange(count):
+        key, pos = _decode(data, pos, zeroCopy)
+        items[key], pos = _decode(data, pos, zeroCopy)
+    return items, pos
+
+def _decodeArray(data, pos, zeroCopy):
+    typecode, count, padding = _arrayHeader.unpack_from(data, pos)
+    pos += _arrayHeader.size + padding
+    view = ArrayView(typecode, data, pos, count)
+    return view if zeroCopy else view.array(), pos + count * view._itemsize
+
+def _decodeWith(convert):
+    def decode(data, pos, zeroCopy):
+        value, pos = _decodeBytes(data, pos)
+        return convert(value), pos
+    return decode
+
+def _decodeStruct(packing, convert):
+    def decode(data, pos, zeroCopy):
+        return convert(*packing.unpack_from(data, pos)), pos + packing.size
+    return decode
+
+_decoders = {
+    'N': lambda data, pos, zeroCopy: (None, pos),
+    'T': lambda data, pos, zeroCopy: (True, pos),
+    'F': lambda data, pos, zeroCopy: (False, pos),
+    'i': _decodeStruct(_int, int),
+    'I': _decodeWith(long),
+    'f': _decodeStruct(_float, float),
+    's': _decodeWith(str),
+    'u': _decodeWith(lambda value: value.decode('utf-8')),
+    'D': _decodeWith(decimal.Decimal),
+    'M': _decodeStruct(_datetime, datetime.datetime),
+    'd': _decodeStruct(_date, datetime.date),
+    'l': _decodeItems,
+    't': _decodeTuple,
+    'g': _decodePacked('d', 8),
+    'h': _decodePacked('q', 8),
+    'm': _decodeDict,
+    'A': _decodeArray,
+    'P': _decodeWith(cPickle.loads),
+}
+
+def _decode(data, pos, zeroCopy):
+    decode = _decoders.get(data[pos])
+    if decode is None:
+        raise RuntimeError("Unknown tag %r at offset %d." % (data[pos], pos))
+    return decode(data, pos + 1, zeroCopy)
+
+
+def dumps(value):
+    """Returns the value encoded as a string."""
+    chunks = _Chunks()
+    _encode(value, chunks)
+    return ''.join(chunks)
+
+def loads(data, zeroCopy=False):
+    """Returns the value encoded in data, a string, buffer or mmap.
+
+    If zeroCopy is set, numeric arrays are returned as ArrayView
+    objects reading from data, which must then be kept unchanged for
+    as long as they are used.
+
+    """
+    return loadsFrom(data, 0, zeroCopy)[0]
+
+def loadsFrom(data, pos, zeroCopy=False):
+    """Returns the value encoded in data at offset pos, and the
+    offset following it.
+
+    """
+    return _decode(data, pos, zeroCopy)
+
+
+class ObjectCodec(object):
+    """Encodes the values set on the stored methods of objects of a
+    graph object class.
+
+    The class's stored methods, in name order, are the schema: an
+    object is encoded as a bitmap of the methods with a value set,
+    followed by those values, so method names are never written.
+
+    """
+    def __init__(self, cls, graph=None):
+        self._cls = cls
+        self._graph = graph or _graph
+        self._fields = sorted(descriptor.name for descriptor in cls._storedGraphMethodDescriptors)
+        self._bitmap = struct.Struct('<%dB' % ((len(self._fields) + 7) // 8))
+
+    @property
+    def fields(self):
+        return list(self._fields)
+
+    def dumps(self, obj, dataStore=None):
+        """Returns the values set on, or visible from, the data store,
+        the root data store by default, reading any not yet read from
+        a lazy load first.
+
+        """
+        graph = self._graph
+        dataStore = dataStore or graph.rootDataStore
+        bits = [0] * self._bitmap.size
+        chunks = _Chunks(['\0' * self._bitmap.size])
+        for i, field in enumerate(self._fields):
+            nodeData = graph.nodeFixedData(getattr(obj, field), dataStore=dataStore)
+            if nodeData is not None:
+                bits[i // 8] |= 1 << (i % 8)
+                _encode(nodeData._value, chunks)
+        chunks[0] = self._bitmap.pack(*bits)
+        return ''.join(chunks)
+
+    def loads(self, data, zeroCopy=False):
+        """Returns a dict of the values encoded by dumps, by method
+        name.
+
+        """
+        bits = self._bitmap.unpack_from(data, 0)
+        pos = self._bitmap.size
+        values = {}
+        for i, field in enumerate(self._fields):
+            if bits[i // 8] & (1 << (i % 8)):
+                values[field], pos = _decode(data, pos, zeroCopy)
+        return values
+
+    def load(self, obj, data):
+        """Sets the values encoded by dumps on the object."""
+        for field, value in self.loads(data).iteritems():
+            getattr(obj, field).setValue(value)
+
+
+def dumpDataStore(dataStore, valid=True):
+    """Returns a snapshot of the NodeData owned by the data store,
+    or of only those with a valid value if valid is set.
+
+    Nodes are identified by their ids, so a snapshot can only be
+    loaded into a data store of the same graph.
+
+    """
+    records = [nodeData for nodeData in dataStore._nodeDataByNodeId.itervalues()
+               if nodeData._dataStore is dataStore and (not valid or nodeData._flags & NodeData.VALID)]
+    chunks = _Chunks([_length.pack(len(records))])
+    for nodeData in records:
+        chunks.append(_nodeData.pack(nodeData._node._id, nodeData._flags))
+        _encode(nodeData._value, chunks)
+    return ''.join(chunks)
+
+def loadDataStore(data, dataStore, zeroCopy=False):
+    """Restores a snapshot taken by dumpDataStore into the data
+    store, replacing the data store's NodeData for the nodes in it,
+    and returns the number of NodeData restored.
+
+    Nodes no longer in the graph are skipped.  Nothing is
+    invalidated, so the data store should not yet have been read.
+
+    """
+    graph = dataStore.graph
+    count, = _length.unpack_from(data, 0)
+    pos = _length.size
+    restored = 0
+    for _ in xrange(count):
+        nodeId, flags = _nodeData.unpack_from(data, pos)
+        value, pos = _decode(data, pos + _nodeData.size, zeroCopy)
+        node = graph.nodeFromId(nodeId)
+        if node is None:
+            continue
+        nodeData = NodeData(node, dataStore)
+        nodeData._flags = flags
+        nodeData._value = value
+        dataStore._nodeDataSet(nodeData)
+        restored += 1
+    return restored
+
+def dumpScenarioDiff(diff):
+    """Returns a ScenarioDiff encoded as a string: its what-ifs, then
+    the base and scenario values of its changed nodes.
+
+    Nodes are identified by their ids, as in dumpDataStore.
+
+    """
+    chunks = _Chunks([_length.pack(len(diff.whatIfs))])
+    for node, value in diff.whatIfs:
+        cleared = value is CLEAR
+        chunks.append(_nodeData.pack(node._id, cleared))
+        if not cleared:
+            _encode(value, chunks)
+    chunks.append(_length.pack(len(diff.changed)))
+    for node, (baseValue, value) in diff.changed.iteritems():
+        chunks.append(_nodeData.pack(node._id, 0))
+        _encode(baseValue, chunks)
+        _encode(value, chunks)
+    return ''.join(chunks)
+
+def loadScenarioDiff(data, graph=None, zeroCopy=False):
+    """Returns the ScenarioDiff encoded by dumpScenarioDiff, ready to
+    be replayed into a new scenario.
+
+    Nodes no longer in the graph are skipped.
+
+    """
+    graph = graph or _graph
+    whatIfs = []
+    count, = _length.unpack_from(data, 0)
+    pos = _length.size
+    for _ in xrange(count):
+        nodeId, cleared = _nodeData.unpack_from(data, pos)
+        pos += _nodeData.size
+        value = CLEAR
+        if not cleared:
+            value, pos = _decode(data, pos, zeroCopy)
+        node = graph.nodeFromId(nodeId)
+        if node is not None:
+            whatIfs.append((node, value))
+    changed = {}
+    count, = _length.unpack_from(data, pos)
+    pos += _length.size
+    for _ in xrange(count):
+        nodeId, _ = _nodeData.unpack_from(data, pos)
+        baseValue, pos = _decode(data, pos + _nodeData.size, zeroCopy)
+        value, pos = _decode(data, pos, zeroCopy)
+        node = graph.nodeFromId(nodeId)
+        if node is not None:
+            changed[node] = (baseValue, value)
+    return ScenarioDiff(graph, whatIfs, changed)
@@ -0,0 +1,315 @@
+"""Persists the stored values of graph objects in SQLite.
+
+A graph method declared Stored is both settable and serializable;
+an ObjectStore saves the values set on the stored methods of graph
+objects, and creates the objects again with the same values set:
+
+    db = nodesdb.ObjectStore('deals.db')
+    db.save(deals + events)
+    deals = db.load(Deal)
+
+Each value is one row, keyed by the object's class, the object's id
+in the store and the method's name, so saving writes a batch of rows
+in one transaction and loading a class reads all its objects' rows
+with one query.  Only the values of stored methods taking no
+arguments are saved, and only those set in, or visible from, the
+data store saved from, the root data store by default.
+
+Objects can also be loaded lazily, with their values only read from
+the database when the graph first needs them.  Reading one object's
+value then reads the same method's values for every object loaded
+with it, again with one query.
+
+"""
+import cPickle
+import importlib
+import sqlite3
+import threading
+import weakref
+
+import nodes
+from nodes.graph import _graph
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    objid INTEGER PRIMARY KEY,
+    class TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS nodevalues (
+    class TEXT NOT NULL,
+    objid INTEGER NOT NULL,
+    field TEXT NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (class, objid, field)
+);
+"""
+
+
+_MAX_QUERY_IDS = 500    # Ids bound to one query, within SQLite's limit of 999 variables.
+
+
+def className(cls):
+    """Returns 'module.Class', the name a class is stored under."""
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+def classNamed(name):
+    """Returns the class stored under the name, or None if it cannot
+    be imported.
+
+    """
+    moduleName, _, name = name.rpartition('.')
+    try:
+        return getattr(importlib.import_module(moduleName), name)
+    except (ImportError, AttributeError):
+        return None
+
+
+class ObjectStore(object):
+    """Saves and loads the stored values of graph objects in the
+    SQLite database at path, ':memory:' for one held in memory.
+
+    Every object saved or loaded is given an id, unique across the
+    store, by which it is identified from then on; loading an object
+    already loaded returns the same object.  Values are serialized
+    with dumps and read back with loads, cPickle's by default; pass
+    codec.dumps and codec.loads for the binary format of codec.
+
+    """
+    def __init__(self, path, graph=None, dumps=None, loads=None):
+        self._path = path
+        self._graph = graph or _graph
+        self._dumps = dumps or (lambda value: cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+        self._loads = loads or cPickle.loads
+        self._lock = threading.Lock()       # Hydration reads on whichever thread reads a node.
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.text_factory = str
+        self._connection.executescript(_SCHEMA)
+        self._nextObjId = (self._connection.execute('SELECT MAX(objid) FROM objects').fetchone()[0] or 0) + 1
+        self._objIds = weakref.WeakKeyDictionary()
+        self._objs = weakref.WeakValueDictionary()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def graph(self):
+        return self._graph
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def objId(self, obj):
+        """Returns the object's id in the store, or None if it has
+        not been saved or loaded.
+
+        """
+        return self._objIds.get(obj)
+
+    def obj(self, objId):
+        """Returns the object with the given id, if it is loaded."""
+        return self._objs.get(objId)
+
+    def save(self, objs, dataStore=None):
+        """Saves the values set on the stored methods of the objects,
+        replacing any saved before, and returns their ids.
+
+        All the objects are written in one transaction.
+
+        """
+        dataStore = dataStore or self._graph.rootDataStore
+        objIds = []
+        newObjs = []
+        keys = []
+        rows = []
+        for obj in objs:
+            objId = self._objIds.get(obj)
+            if objId is None:
+                objId = self._nextObjId
+                self._nextObjId += 1
+                newObjs.append((objId, className(obj.__class__)))
+                self._objIds[obj] = objId
+                self._objs[objId] = obj
+            objIds.append(objId)
+            name = className(obj.__class__)
+            keys.append((name, objId))
+            for field, value in self._values(obj, dataStore):
+                rows.append((name, objId, field, sqlite3.Binary(self._dumps(value))))
+        with self._connection:
+            self._connection.executemany('INSERT INTO objects (objid, class) VALUES (?, ?)', newObjs)
+            # Deleting by class as well as objid lets the primary key be used.
+            self._connection.executemany('DELETE FROM nodevalues WHERE class = ? AND objid = ?', keys)
+            self._connection.executemany('INSERT INTO nodevalues (class, objid, field, value) VALUES (?, ?, ?, ?)', rows)
+        return objIds
+
+    def _values(self, obj, dataStore):
+        """Yields (name, value) for each stored method of the object
+        with a value set in, or visible from, the data store.
+
+        Values of a lazily loaded object not yet read are read first,
+        so saving it does not drop them.
+
+        """
+        graph = self._graph
+        for descriptor in obj._storedGraphMethodDescriptors:
+            nodeData = graph.nodeFixedData(getattr(obj, descriptor.name), dataStore=dataStore)
+            if nodeData is not None:
+                yield descriptor.name, nodeData.value
+
+    def delete(self, objs):
+        """Deletes the objects and their saved values from the store."""
+        keys = []
+        for obj in objs:
+            objId = self._objIds.pop(obj, None)
+            if objId is not None:
+                self._objs.pop(objId, None)
+                keys.append((className(obj.__class__), objId))
+        with self._connection:
+            self._connection.executemany('DELETE FROM nodevalues WHERE class = ? AND objid = ?', keys)
+            self._connection.executemany('DELETE FROM objects WHERE objid = ?', [(objId,) for name, objId in keys])
+
+    def objIds(self, cls):
+        """Returns the ids of the saved objects of the class."""
+        cursor = self._connection.execute('SELECT objid FROM objects WHERE class = ? ORDER BY objid', (className(cls),))
+        return [row[0] for row in cursor]
+
+    def loadIds(self, objIds, lazy=False):
+        """Returns a dict of the objects with the given ids, of any
+        class, by id, loading those not already loaded with one load
+        per class.
+
+        Objects whose class cannot be imported are left out.
+
+        """
+        objs = {}
+        missing = []
+        for objId in set(objIds):
+            obj = self._objs.get(objId)
+            if obj is None:
+                missing.append(objId)
+            else:
+                objs[objId] = obj
+        objIdsByClass = {}
+        with self._lock:
+            for i in xrange(0, len(missing), _MAX_QUERY_IDS):
+                ids = missing[i:i + _MAX_QUERY_IDS]
+                for objId, name in self._connection.execute(
+                        'SELECT objid, class FROM objects WHERE objid IN (%s)' % ','.join('?' * len(ids)), ids):
+                    objIdsByClass.setdefault(name, []).append(objId)
+        for name, ids in objIdsByClass.iteritems():
+            cls = classNamed(name)
+            if cls is not None:
+                for obj in self.load(cls, ids, lazy=lazy):
+                    objs[self._objIds[obj]] = obj
+        return objs
+
+    def load(self, cls, objIds=None, lazy=False):
+        """Returns the saved objects of the class, or those with the
+        given ids, in the order of their ids, with their stored values
+        set in the root data store.
+
+        The values of every object are read with one query, and set
+        in one batch.  If lazy is set only the objects are created,
+        and each stored method's values are read and set for all of
+        them the first time the graph reads one; see Graph.hydrate.
+
+        """
+        name = className(cls)
+        if lazy:
+            if objIds is None:
+                loadSet = None
+                objIds = self.objIds(cls)
+            else:
+                loadSet = objIds = sorted(set(objIds) & set(self.objIds(cls)))
+            objs = [self._objLoaded(cls, objId) for objId in objIds]
+            self._graph.hydrate(objs, _Hydrator(self, cls, loadSet))
+            return objs
+        if objIds is None:
+            cursor = self._connection.execute(
+                'SELECT o.objid, v.field, v.value FROM objects o LEFT JOIN nodevalues v'
+                ' ON v.class = o.class AND v.objid = o.objid'
+                ' WHERE o.class = ? ORDER BY o.objid', (name,))
+        else:
+            self._connection.execute('CREATE TEMP TABLE IF NOT EXISTS loading (objid INTEGER PRIMARY KEY)')
+            self._connection.execute('DELETE FROM loading')
+            self._connection.executemany('INSERT OR IGNORE INTO loading (objid) VALUES (?)', ((objId,) for objId in objIds))
+            cursor = self._connection.execute(
+                'SELECT o.objid, v.field, v.value FROM loading l JOIN objects o ON o.objid = l.objid'
+                ' LEFT JOIN nodevalues v ON v.class = o.class AND v.objid = o.objid'
+                ' WHERE o.class = ? ORDER BY o.objid', (name,))
+        fields = set(descriptor.name for descriptor in cls._storedGraphMethodDescriptors)
+        objs = []
+        loads = self._loads
+        with nodes.batch():
+            obj = objId = None
+            for rowObjId, field, value in cursor:
+                if rowObjId != objId:
+                    objId = rowObjId
+                    obj = self._objLoaded(cls, objId)
+                    objs.append(obj)
+                if field in fields:
+                    getattr(obj, field).setValue(loads(str(value)))
+        return objs
+
+    def _objLoaded(self, cls, objId):
+        obj = self._objs.get(objId)
+        if obj is None:
+            obj = cls()
+            self._objIds[obj] = objId
+            self._objs[objId] = obj
+        return obj
+
+    def _fieldValues(self, cls, field, objIds):
+        """Returns (objid, value) rows of the field for the objects
+        with the given ids, or of every object of the class if all.
+
+        """
+        query = 'SELECT objid, value FROM nodevalues WHERE class = ? AND field = ?'
+        args = (className(cls), field)
+        with self._lock:
+            if objIds is None:
+                return self._connection.execute(query, args).fetchall()
+            rows = []
+            for i in xrange(0, len(objIds), _MAX_QUERY_IDS):
+                ids = objIds[i:i + _MAX_QUERY_IDS]
+                rows.extend(self._connection.execute(
+                    '%s AND objid IN (%s)' % (query, ','.join('?' * len(ids))), args + tuple(ids)))
+            return rows
+
+
+class _Hydrator(object):
+    """Reads the values of a stored method for every object loaded
+    together, the first time the graph reads it for one of them.
+
+    """
+    def __init__(self, store, cls, objIds):
+        self._store = store
+        self._cls = cls
+        self._objIds = objIds   # Or None if every object of the class was loaded.
+        self._fields = set(descriptor.name for descriptor in cls._storedGraphMethodDescriptors)
+        self._lock = threading.Lock()
+
+    def hydrate(self, node):
+        field = node.descriptor.name
+        if node.args or field not in self._fields:
+            return False
+        with self._lock:
+            if field not in self._fields:
+                return False
+            store = self._store
+            hydrated = False
+            for objId, value in store._fieldValues(self._cls, field, self._objIds):
+                obj = store._objs.get(objId)
+                if obj is not None:
+                    objNode = getattr(obj, field).node()
+                    if store._graph.nodeHydrate(objNode, store._loads(str(value))) and objNode is node:
+                        hydrated = True
+            self._fields.discard(field)
+        return hydrated
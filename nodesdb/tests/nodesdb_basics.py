@@ -0,0 +1,270 @@
+import array
+import datetime
+import decimal
+import gc
+import nodes
+import nodesdb
+import os
+import tempfile
+import unittest
+
+class Trade(nodes.GraphObject):
+
+    @nodes.graphMethod(nodes.Stored)
+    def Quantity(self):
+        return 0
+
+    @nodes.graphMethod(nodes.Stored)
+    def Price(self):
+        return decimal.Decimal('0')
+
+    @nodes.graphMethod(nodes.Stored)
+    def TradeTime(self):
+        return None
+
+    @nodes.graphMethod(nodes.Settable)
+    def Note(self):
+        return ''
+
+    @nodes.graphMethod
+    def Value(self):
+        return self.Quantity() * self.Price()
+
+class Fee(nodes.GraphObject):
+
+    @nodes.graphMethod(nodes.Stored)
+    def Amount(self):
+        return 0
+
+calls = []
+
+class Portfolio(nodes.GraphObject):
+
+    @nodes.graphMethod(nodes.Stored)
+    def Scale(self):
+        return 1
+
+    @nodes.graphMethod
+    def Total(self, trade):
+        calls.append('Total')
+        return trade.Value() * self.Scale()
+
+    @nodes.graphMethod
+    def Vector(self):
+        return array.array('d', [self.Scale()] * 100)
+
+class NodesDbTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_saveLoad(self):
+        when = datetime.datetime(2013, 5, 1, 9, 30)
+        trades = [Trade(Quantity=i, Price=decimal.Decimal('1.5'), TradeTime=when, Note='n') for i in range(100)]
+        trades.append(Trade())
+        fee = Fee(Amount=3)
+        with nodesdb.ObjectStore(self.path) as db:
+            objIds = db.save(trades + [fee])
+            self.assertEquals(len(set(objIds)), 102)
+            self.assertEquals(db.objId(fee), objIds[-1])
+            self.assertEquals(db.objIds(Trade), objIds[:-1])
+            self.assertTrue(db.obj(objIds[0]) is trades[0])
+            trades[0].Quantity = 7
+            self.assertEquals(db.save([trades[0]]), objIds[:1])
+
+        del trades, fee
+        with nodesdb.ObjectStore(self.path) as db:
+            trades = db.load(Trade)
+            self.assertEquals(len(trades), 101)
+            self.assertEquals(trades[0].Quantity(), 7)
+            self.assertEquals(trades[5].Value(), decimal.Decimal('7.5'))
+            self.assertEquals(trades[5].TradeTime(), when)
+            self.assertEquals(trades[5].Note(), '')
+            self.assertEquals(trades[-1].Quantity(), 0)
+            self.assertEquals([db.objId(trade) for trade in trades], objIds[:-1])
+            self.assertTrue(db.load(Trade, objIds[3:5])[1] is trades[4])
+            fees = db.load(Fee)
+            self.assertEquals([fee.Amount() for fee in fees], [3])
+
+            db.delete(trades[:50])
+            self.assertEquals(len(db.objIds(Trade)), 51)
+            self.assertEquals(db._connection.execute('SELECT COUNT(*) FROM nodevalues WHERE objid = ?', (objIds[0],)).fetchone()[0], 0)
+            db.save([Fee()])
+            self.assertEquals(len(db.objIds(Fee)), 2)
+
+    def test_lazyLoad(self):
+        graph = nodes.graph._graph
+        with nodesdb.ObjectStore(self.path) as db:
+            db.save([Trade(Quantity=i, Price=decimal.Decimal(i)) for i in range(10)] + [Trade()])
+
+        with nodesdb.ObjectStore(self.path) as db:
+            trades = db.load(Trade, lazy=True)
+            self.assertEquals(len(trades), 11)
+            trades[2].Price = decimal.Decimal('0.5')
+            self.assertEquals(graph.nodeResolve(trades[7].Quantity, createIfMissing=False), None)
+
+            self.assertEquals(trades[3].Value(), 9)
+            quantity = graph.nodeResolve(trades[7].Quantity, createIfMissing=False)
+            self.assertTrue(graph.rootDataStore.nodeData(quantity, createIfMissing=False).fixed)
+            price = graph.nodeResolve(trades[7].Price, createIfMissing=False)
+            self.assertEquals(graph.rootDataStore.nodeData(price, createIfMissing=False).value, 7)
+            self.assertEquals(trades[2].Value(), 1)
+            self.assertEquals(trades[10].Value(), 0)
+            trades[7].Quantity.clearValue()
+            self.assertEquals(trades[7].Quantity(), 0)
+
+            some = db.load(Trade, [db.objId(trades[0]), db.objId(trades[1])], lazy=True)
+            self.assertTrue(some[1] is trades[1])
+
+    def test_lazyLoadSave(self):
+        with nodesdb.ObjectStore(self.path) as db:
+            db.save([Trade(Quantity=5, Price=decimal.Decimal('2')), Fee(Amount=4)])
+
+        with nodesdb.ObjectStore(self.path) as db:
+            trades = db.load(Trade, lazy=True)
+            fees = db.load(Fee, lazy=True)
+            data = nodesdb.ObjectCodec(Fee).dumps(fees[0])
+            self.assertEquals(nodesdb.ObjectCodec(Fee).loads(data), {'Amount': 4})
+            db.save(trades + fees)
+            count, = db._connection.execute('SELECT COUNT(*) FROM nodevalues').fetchone()
+            self.assertEquals(count, 3)
+        del trades, fees
+        gc.collect()
+
+        with nodesdb.ObjectStore(self.path) as db:
+            trade, = db.load(Trade)
+            self.assertEquals(trade.Value(), 10)
+
+    def test_codec(self):
+        values = [None, True, 3, -2 ** 70, 1.5, 'abc', u'\xe9', decimal.Decimal('-1.25'),
+                  datetime.datetime(2013, 5, 1, 9, 30, 0, 15), datetime.date(2013, 5, 1),
+                  [1.0, 2.5], [1, 2], [[1, 'a'], (2.0, None)], {'a': [1, 2]}, set([1])]
+        self.assertEquals(nodesdb.codec.loads(nodesdb.codec.dumps(values)), values)
+
+        vector = array.array('d', range(1000))
+        data = nodesdb.codec.dumps(['x', vector])
+        self.assertEquals(nodesdb.codec.loads(data)[1], vector)
+        view = nodesdb.codec.loads(data, zeroCopy=True)[1]
+        self.assertEquals(len(view), 1000)
+        self.assertEquals(view[-1], 999.0)
+        self.assertEquals(view.array(), vector)
+        self.assertEquals(len(view.buffer()), 8000)
+        vectors = [array.array('l', [i] * (i % 3)) if i % 2 else 'x' * i for i in range(2000)]
+        self.assertEquals([value.tolist() if i % 2 else value for i, value in
+                           enumerate(nodesdb.codec.loads(nodesdb.codec.dumps(vectors), zeroCopy=True))],
+                          [value.tolist() if i % 2 else value for i, value in enumerate(vectors)])
+
+        when = datetime.datetime(2013, 5, 1, 9, 30)
+        trade = Trade(Quantity=3, TradeTime=when)
+        objectCodec = nodesdb.ObjectCodec(Trade)
+        self.assertEquals(objectCodec.fields, ['Price', 'Quantity', 'TradeTime'])
+        data = objectCodec.dumps(trade)
+        self.assertEquals(objectCodec.loads(data), {'Quantity': 3, 'TradeTime': when})
+        other = Trade()
+        objectCodec.load(other, data)
+        self.assertEquals(other.Quantity(), 3)
+
+        graph = nodes.graph._graph
+        with nodes.scenario() as scenario:
+            trade.Quantity.setWhatIf(5)
+            self.assertEquals(trade.Value(), 0)
+        data = nodesdb.codec.dumpDataStore(scenario)
+        restored = nodes.graph.Scenario(graph)
+        self.assertEquals(nodesdb.codec.loadDataStore(data, restored), 3)
+        with restored:
+            self.assertEquals(trade.Quantity(), 5)
+
+        with nodes.scenario() as bumped:
+            trade.Price.setWhatIf(decimal.Decimal('1.5'))
+        diff = bumped.diff([trade.Value.node()], scenario)
+        data = nodesdb.codec.dumpScenarioDiff(diff)
+        loaded = nodesdb.codec.loadScenarioDiff(data)
+        self.assertEquals(loaded.changed, {trade.Value.node(): (0, decimal.Decimal('4.5'))})
+        self.assertEquals(sorted(loaded.whatIfs), sorted([(trade.Price.node(), decimal.Decimal('1.5')),
+                                                          (trade.Quantity.node(), nodes.graph.CLEAR)]))
+        with loaded.replay(scenario.copy()):
+            self.assertEquals(trade.Value(), decimal.Decimal('4.5'))
+
+    def test_checkpoint(self):
+        graph = nodes.graph._graph
+        fd, path = tempfile.mkstemp(suffix='.ck')
+        os.close(fd)
+        try:
+            db = nodesdb.ObjectStore(self.path)
+            trades = [Trade(Quantity=i, Price=decimal.Decimal(2)) for i in range(3)]
+            portfolio = Portfolio(Scale=10)
+            db.save(trades + [portfolio])
+            unsaved = Trade(Quantity=5)
+            totals = [portfolio.Total(trade) for trade in trades + [unsaved]]
+            portfolio.Vector()
+            self.assertEquals(graph.checkpoint(path, db),
+                              {'nodes': 14, 'edges': 13, 'values': 14})
+            del trades, portfolio, unsaved
+            db.close()
+            gc.collect()
+
+            db = nodesdb.ObjectStore(self.path)
+            self.assertEquals(graph.restore(path, db), {'nodes': 14, 'edges': 13, 'values': 14})
+            trades = db.load(Trade, lazy=True)
+            portfolio, = db.load(Portfolio, lazy=True)
+            del calls[:]
+            self.assertEquals([portfolio.Total(trade) for trade in trades], totals[:3])
+            self.assertEquals(calls, [])
+            vector = portfolio.Vector()
+            self.assertEquals(type(vector), array.array)
+            self.assertEquals(vector, array.array('d', [10.0] * 100))
+            self.assertEquals(vector + array.array('d', [1.0]), array.array('d', [10.0] * 100 + [1.0]))
+
+            self.assertFalse(trades[2].Value.node().valid())     # Leaves empty NodeData in the root.
+            trades[2].Quantity = 3
+            self.assertEquals(trades[2].Value(), 6)
+            trades[2].Quantity = 2
+
+            trades[1].Quantity = 4
+            self.assertEquals(portfolio.Total(trades[1]), 80)
+            self.assertEquals(calls, ['Total'])
+            with nodes.scenario():
+                portfolio.Scale.setWhatIf(1)
+                self.assertEquals(portfolio.Total(trades[2]), 4)
+            self.assertEquals(portfolio.Total(trades[2]), 40)
+            portfolio.Scale.clearValue()
+            self.assertEquals(portfolio.Total(trades[0]), 0)
+            self.assertEquals(portfolio.Total(trades[2]), 4)
+            db.close()
+        finally:
+            os.remove(path)
+
+    def test_checkpointComputeDepth(self):
+        graph = nodes.graph._graph
+        fd, path = tempfile.mkstemp(suffix='.ck')
+        os.close(fd)
+        try:
+            db = nodesdb.ObjectStore(self.path)
+            trade = Trade(Quantity=3, Price=decimal.Decimal(5))
+            db.save([trade])
+            self.assertEquals(trade.Value(), 15)
+            graph.checkpoint(path, db)
+            del trade
+            db.close()
+            gc.collect()
+
+            db = nodesdb.ObjectStore(self.path)
+            graph.restore(path, db)
+            trade, = db.load(Trade, lazy=True)
+            graph.maxComputeDepth = 4
+            try:
+                trade.Quantity = 10
+                self.assertEquals(trade.Value(), 50)
+                self.assertEquals(trade.Price(), 5)
+            finally:
+                graph.maxComputeDepth = None
+            db.close()
+        finally:
+            os.remove(path)
+
+if __name__ == '__main__':
+    unittest.main()